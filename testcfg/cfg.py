@@ -7,6 +7,7 @@ tuple of nonterminals and terminals.
 
 """
 import collections
+import hashlib
 
 import finiteautomaton
 import tarjan
@@ -25,6 +26,53 @@ class ContextFreeGrammar:
         self.terminals = set()
         self.nonterminals = set()
         self.productions = set()
+        self._index = None
+        self._index_key = None
+
+    def get_index(self):
+        """
+        Returns the compiled, integer-interned view of this grammar. The
+        view is built on first use and rebuilt whenever one of the
+        symbol or production sets has been replaced or has changed size.
+        Call invalidate_index after any other in-place mutation.
+
+        :rtype: GrammarIndex
+        :return: An index of this grammar.
+        """
+        key = (self.productions, len(self.productions),
+               self.nonterminals, len(self.nonterminals),
+               self.terminals, len(self.terminals),
+               self.start_set, len(self.start_set))
+        old_key = self._index_key
+        if old_key is None or old_key[1::2] != key[1::2] or \
+                any(a is not b for a, b in zip(old_key[0::2], key[0::2])):
+            self._index = GrammarIndex(self)
+            self._index_key = key
+        return self._index
+
+    def invalidate_index(self):
+        """
+        Discards the compiled view of this grammar.
+
+        :return: None
+        """
+        self._index = None
+        self._index_key = None
+
+    def fingerprint(self):
+        """
+        Computes a hash of this grammar that does not depend on the order
+        of iteration over its sets, so that it is stable across runs.
+
+        :rtype: str
+        :return: A hexadecimal SHA-1 digest.
+        """
+        digest = hashlib.sha1()
+        for part in (self.start_set, self.nonterminals, self.terminals,
+                     self.productions):
+            digest.update(repr(sorted(part)))
+            digest.update("\n")
+        return digest.hexdigest()
 
     def copy(self):
         """
@@ -86,43 +134,37 @@ class ContextFreeGrammar:
         """
         Finds all the nonterminals that generate a string.
 
+        This is the standard linear-time emptiness algorithm: each
+        production keeps a count of the right-hand side symbols that are
+        not yet known to generate a string, and its left-hand side is
+        put on the agenda when the count drops to zero.
+
         :rtype: set
         :return: The set of all nonterminals that generate a string.
         """
+        index = self.get_index()
+        remaining = []
+        agenda = []
+        for p in xrange(len(index.productions)):
+            n = 0
+            for s in index.rhs(p):
+                if not index.is_terminal[s]:
+                    n += 1
+            remaining.append(n)
+            if n == 0:
+                agenda.append(index.prod_lhs[p])
+        done = [False] * len(index.symbols)
         coreachable = set()
-        iteration = 0
-        done_this_loop = 0
-        prodmap = collections.defaultdict(list)
-        for prod in self.productions:
-            prodmap[prod[0]].append(prod)
-        remaining = set(self.nonterminals)
-        while iteration == 0 or done_this_loop > 0:
-            iteration += 1
-            done_this_loop = 0
-            for nt in remaining:
-                ## try some rules with this on the ljs
-                ok = True
-
-                for prod in prodmap[nt]:
-                    # Is the rhs of this rule all coreachable \cup terminals
-                    for symbol in prod[1]:
-                        if (not symbol in self.terminals) and (not symbol in coreachable):
-                            # we can't use this rule
-                            break
-                    else:
-                        # This production is good so we break from the outer loop
-                        break
-                else:
-                    ok = False
-                if ok:
-                    done_this_loop += 1
-                    coreachable.add(nt)
-            # now remove the ones we just did.
-            remaining2 = set()
-            for nt in remaining:
-                if not nt in coreachable:
-                    remaining2.add(nt)
-            remaining = remaining2
+        while agenda:
+            s = agenda.pop()
+            if done[s] or not index.is_nonterminal[s]:
+                continue
+            done[s] = True
+            coreachable.add(index.symbols[s])
+            for p, k in index.occurrences_of(s):
+                remaining[p] -= 1
+                if remaining[p] == 0:
+                    agenda.append(index.prod_lhs[p])
         return coreachable
 
     def compute_nonnulling(self):
@@ -133,40 +175,31 @@ class ContextFreeGrammar:
         :return: The set of all nonterminals that generate a nonempty
             string.
         """
+        index = self.get_index()
         coreachable = self.compute_coreachable()
-        # collect the  productions that all generate something.
-        good_productions = set()
-        for prod in self.productions:
-            for symbol in prod[1]:
-                if not symbol in coreachable and not symbol in self.terminals:
-                    break
-            else:
-                good_productions.add(prod)
+        good = self._good_productions(coreachable)
+        in_coreachable = [s in coreachable for s in index.symbols]
+        done = [False] * len(index.symbols)
+        agenda = []
+        for p in xrange(len(index.productions)):
+            if good[p] and in_coreachable[index.prod_lhs[p]]:
+                for s in index.rhs(p):
+                    if index.is_terminal[s]:
+                        agenda.append(index.prod_lhs[p])
+                        break
         nonnulling = set()
-        iteration = 0
-        done_this_loop = 0
-        while iteration == 0 or done_this_loop > 0:
-            iteration += 1
-            done_this_loop = 0
-            for nt in coreachable:
-                if not nt in nonnulling:
-                    ## try some rules with this on the lhs
-                    ok = True
-
-                    for prod in good_productions:
-                        if prod[0] == nt:
-                            # Is the rhs of this rule all coreachable \cup terminals
-                            # with at least one nonnulling
-                            nonnulling_prod = False
-                            for symbol in prod[1]:
-                                if symbol in nonnulling or symbol in self.terminals:
-                                    nonnulling_prod = True
-                                    break
-                            if nonnulling_prod:
-                                # it doesn't only generate the empty string
-                                nonnulling.add(nt)
-                                done_this_loop += 1
-                                break
+        while agenda:
+            s = agenda.pop()
+            if done[s]:
+                continue
+            done[s] = True
+            nonnulling.add(index.symbols[s])
+            # any good production with s on the rhs now generates
+            # a nonempty string.
+            for p, k in index.occurrences_of(s):
+                lhs = index.prod_lhs[p]
+                if good[p] and in_coreachable[lhs] and not done[lhs]:
+                    agenda.append(lhs)
         return nonnulling
 
     def _check_tuple(self, tup, symbol_set):
@@ -206,61 +239,84 @@ class ContextFreeGrammar:
         """
         Finds all the nonterminals that generate the empty string.
 
+        Each production keeps a count of the right-hand side occurrences
+        that are not yet known to be nullable; its left-hand side becomes
+        nullable when the count reaches zero.
+
         :rtype: set
         :return: The set of all nonterminals that generate the empty string.
         """
+        index = self.get_index()
+        remaining = []
+        agenda = []
+        for p in xrange(len(index.productions)):
+            n = index.rhs_offsets[p + 1] - index.rhs_offsets[p]
+            remaining.append(n)
+            if n == 0:
+                agenda.append(index.prod_lhs[p])
+        done = [False] * len(index.symbols)
         nullable = set()
-        for prod in self.productions:
-            if len(prod[1]) == 0:
-                nullable.add(prod[0])
-        if len(nullable) == 0:
-            return nullable
-        # otherwise we now need to do some work.
-        newones = 1
-        while newones > 0:
-            newones = 0
-            for prod in self.productions:
-                if not prod[0] in nullable:
-                    # this might be nullable
-                    if self._check_tuple(prod[1], nullable):
-                        # then this is also nullable.
-                        nullable.add(prod[0])
-                        newones += 1
+        while agenda:
+            s = agenda.pop()
+            if done[s]:
+                continue
+            done[s] = True
+            nullable.add(index.symbols[s])
+            for p, k in index.occurrences_of(s):
+                remaining[p] -= 1
+                if remaining[p] == 0:
+                    agenda.append(index.prod_lhs[p])
         return nullable
 
+    def _good_productions(self, coreachable):
+        """
+        Flags the productions whose right-hand sides consist only of
+        terminals and coreachable nonterminals.
+
+        :type coreachable: set
+        :param coreachable: The output of compute_coreachable.
+
+        :rtype: list
+        :return: A list of booleans indexed by production id.
+        """
+        index = self.get_index()
+        ok = [index.is_terminal[s] or index.symbols[s] in coreachable
+              for s in xrange(len(index.symbols))]
+        good = []
+        for p in xrange(len(index.productions)):
+            for s in index.rhs(p):
+                if not ok[s]:
+                    good.append(False)
+                    break
+            else:
+                good.append(True)
+        return good
+
     def compute_trim_set(self):
         """
         return the set of all nonterminals A that can both generate a string
         and have a context.
         """
-        # print "computing coreachable"
+        index = self.get_index()
         coreachable = self.compute_coreachable()
-        # print "coreachable", coreachable
-        trim = set()
         # good productions are those where the rhs are all generable.
-        # this saves some time checking duff productions many times.
-        good_productions = set()
-        for prod in self.productions:
-            for symbol in prod[1]:
-                if not symbol in coreachable and not symbol in self.terminals:
-                    break
-            else:
-                good_productions.add(prod)
-                # print "good_productions", len(good_productions)
+        good = self._good_productions(coreachable)
+        trim = set()
+        agenda = []
         for s in self.start_set:
             if s in coreachable:
                 trim.add(s)
-        done = len(trim)
-        # print "start ", done
-        while done > 0:
-            done = 0
-            for prod in good_productions:
-                if prod[0] in trim:
-                    for symbol in prod[1]:
-                        if symbol in self.nonterminals and not symbol in trim:
-                            done += 1
-                            trim.add(symbol)
-                            # print "Trim set", trim
+                agenda.append(index.symbol_ids[s])
+        while agenda:
+            s = agenda.pop()
+            for p in index.prods_with_lhs(s):
+                if good[p]:
+                    for r in index.rhs(p):
+                        if index.is_nonterminal[r]:
+                            symbol = index.symbols[r]
+                            if not symbol in trim:
+                                trim.add(symbol)
+                                agenda.append(r)
         return trim
 
     def trim(self):
@@ -296,6 +352,28 @@ class ContextFreeGrammar:
         trim = self.compute_trim_set()
         return len(trim) == len(self.nonterminals)
 
+    def is_cnf(self):
+        """
+        Checks to see whether this grammar is in Chomsky normal form,
+        i.e. every production is of the form A -> B C, where B and C are
+        nonterminals, or A -> a, where a is a terminal.
+
+        :rtype: bool
+        :return: True if this grammar is in CNF; False otherwise.
+        """
+        for prod in self.productions:
+            rhs = prod[1]
+            if len(rhs) == 2:
+                if not (rhs[0] in self.nonterminals and
+                        rhs[1] in self.nonterminals):
+                    return False
+            elif len(rhs) == 1:
+                if not rhs[0] in self.terminals:
+                    return False
+            else:
+                return False
+        return True
+
     def has_unary_loops(self):
         """
         return true if this grammar has unary loops (also considering nullary rules.)
@@ -316,13 +394,12 @@ class ContextFreeGrammar:
         """
         return true if we have a production A -> w.
         """
-        for prod in self.productions:
-            if prod[0] == nt:
-                for r in prod[1]:
-                    if not r in self.terminals:
-                        break
-                else:
-                    return prod[1]
+        for prod in self.get_index().lhs_productions(nt):
+            for r in prod[1]:
+                if not r in self.terminals:
+                    break
+            else:
+                return prod[1]
         return False
 
     def is_terminal_production(self, production):
@@ -509,22 +586,13 @@ class ContextFreeGrammar:
         """
         How many productions does this nonterminal appear on the left hand side of?
         """
-        n = 0
-        for prod in self.productions:
-            if prod[0] == nonterminal:
-                n += 1
-        return n
+        return len(self.get_index().lhs_productions(nonterminal))
 
     def count_productions_rhs(self, nonterminal):
         """
         How many productions does this nonterminal appear on the right hand side of?
         """
-        n = 0
-        for prod in self.productions:
-            for nt in prod[1]:
-                if nt == nonterminal:
-                    n += 1
-        return n
+        return len(self.get_index().rhs_occurrences(nonterminal))
 
     """ Methods for intersecting a grammar with a regular language """
 
@@ -533,8 +601,7 @@ class ContextFreeGrammar:
         return a grammar that generates L(G) \cap w\Sigma^*.
         """
         fa = finiteautomaton.make_prefix(prefix, self.terminals)
-        intersected_grammar = fa.intersect_cfg(self)
-        grammar = intersected_grammar.trim()
+        grammar = fa.intersect_cfg(self, pruned=True)
         return grammar
 
     def infix_grammar(self, infix):
@@ -542,9 +609,7 @@ class ContextFreeGrammar:
         return a grammar that generates L(G) \cap \Sigma^* w \Sigma^*.
         """
         fa = finiteautomaton.make_infix(infix, self.terminals)
-        intersected_grammar = fa.intersect_cfg(self)
-        # print "Trimming"
-        grammar = intersected_grammar.trim()
+        grammar = fa.intersect_cfg(self, pruned=True)
         return grammar
 
     def infix_grammar_without_nt(self, infix, nonterminal):
@@ -558,23 +623,26 @@ class ContextFreeGrammar:
         of the given nonterminal.
         """
         fa = finiteautomaton.make_infix_long(infix, self.terminals)
-        intersected_grammar = fa.intersect_cfg_remove(self, nonterminal)
-        # print "Trimming"
-        grammar = intersected_grammar.trim()
+        grammar = fa.intersect_cfg_remove(self, nonterminal, pruned=True)
         return grammar
 
+    def infix_witness_without_nt(self, infix, nonterminal):
+        """
+        return a string of the grammar infix_grammar_without_nt(infix,
+        nonterminal), or None if that grammar is empty. The intersected
+        grammar is never built.
+        """
+        fa = finiteautomaton.make_infix_long(infix, self.terminals)
+        return finiteautomaton.intersection_witness(fa, self, nonterminal)
+
     def single_occurrence_grammar(self, symbol):
         """
         return a grammar that generatse L(G) \cap (\Sigma-a)^* a (\Sigma-a)^*.
         """
-        vocab = set(self.terminals)
-        vocab.remove(symbol)
         # print "Symbol is" , symbol
-        fa = finiteautomaton.make_infix((symbol,), vocab)
+        fa = finiteautomaton.make_infix((symbol,), self.terminals, (symbol,))
         # fa.dump()
-        intersected_grammar = fa.intersect_cfg(self)
-        # intersected_grammar.dump()
-        grammar = intersected_grammar.trim()
+        grammar = fa.intersect_cfg(self, pruned=True)
         return grammar
 
     def context_grammar(self, context):
@@ -582,8 +650,7 @@ class ContextFreeGrammar:
         return a grammar that generates L(G) \cap l\Sigma^* r.
         """
         fa = finiteautomaton.make_context(context, self.terminals)
-        intersected_grammar = fa.intersect_cfg(self)
-        grammar = intersected_grammar.trim()
+        grammar = fa.intersect_cfg(self, pruned=True)
         return grammar
 
     def context_grammar_without_nt(self, context, nonterminal):
@@ -592,10 +659,18 @@ class ContextFreeGrammar:
         but where the string l cannot be generated by the given nonterminal.
         """
         fa = finiteautomaton.make_context_long(context, self.terminals)
-        intersected_grammar = fa.intersect_cfg_remove(self, nonterminal)
-        grammar = intersected_grammar.trim()
+        grammar = fa.intersect_cfg_remove(self, nonterminal, pruned=True)
         return grammar
 
+    def context_witness_without_nt(self, context, nonterminal):
+        """
+        return a string of the grammar context_grammar_without_nt(context,
+        nonterminal), or None if that grammar is empty. The intersected
+        grammar is never built.
+        """
+        fa = finiteautomaton.make_context_long(context, self.terminals)
+        return finiteautomaton.intersection_witness(fa, self, nonterminal)
+
     def store(self, filename):
         fhandle = open(filename, 'w')
         fhandle.write("# CFG \n")
@@ -685,6 +760,177 @@ class ContextFreeGrammar:
         self.productions = set(new_prods)
 
 
+class GrammarIndex:
+    """
+    A compiled view of a ContextFreeGrammar, used by the algorithms that
+    would otherwise scan the whole production set for every query.
+
+    Symbols are interned to dense integers: the nonterminals (and any
+    other symbol that occurs on a left-hand side) come first, then the
+    terminals, then any remaining right-hand side symbols. Productions
+    are numbered and stored in CSR style: for each grouping there is an
+    offsets list and a flat list of production ids, so that the
+    productions of group g are ids[offsets[g]:offsets[g + 1]].
+
+    The index is a snapshot; it does not track later changes to the
+    grammar. Use ContextFreeGrammar.get_index to obtain a current one.
+    """
+
+    def __init__(self, grammar):
+        symbols = list(grammar.nonterminals)
+        symbol_ids = dict((s, i) for i, s in enumerate(symbols))
+        for prod in grammar.productions:
+            if not prod[0] in symbol_ids:
+                symbol_ids[prod[0]] = len(symbols)
+                symbols.append(prod[0])
+        self.number_nonterminals = len(symbols)
+        for s in grammar.terminals:
+            if not s in symbol_ids:
+                symbol_ids[s] = len(symbols)
+                symbols.append(s)
+        for prod in grammar.productions:
+            for s in prod[1]:
+                if not s in symbol_ids:
+                    symbol_ids[s] = len(symbols)
+                    symbols.append(s)
+        self.symbols = symbols
+        self.symbol_ids = symbol_ids
+        self.is_terminal = [s in grammar.terminals for s in symbols]
+        self.is_nonterminal = [s in grammar.nonterminals for s in symbols]
+        self.start_ids = [symbol_ids[s] for s in grammar.start_set
+                          if s in symbol_ids]
+
+        self.productions = list(grammar.productions)
+        self.prod_lhs = [symbol_ids[prod[0]] for prod in self.productions]
+        self.rhs_offsets = [0]
+        self.rhs_symbols = []
+        for prod in self.productions:
+            self.rhs_symbols.extend(symbol_ids[s] for s in prod[1])
+            self.rhs_offsets.append(len(self.rhs_symbols))
+
+        nsymbols = len(symbols)
+        # productions grouped by left-hand side
+        self.lhs_offsets, self.lhs_prods = _csr(
+            nsymbols, enumerate(self.prod_lhs))
+        # occurrences grouped by right-hand side symbol, as parallel
+        # lists of production ids and positions
+        occurrences = []
+        for p in xrange(len(self.productions)):
+            start = self.rhs_offsets[p]
+            for k in xrange(start, self.rhs_offsets[p + 1]):
+                occurrences.append((self.rhs_symbols[k], p, k - start))
+        self.occ_offsets, self.occ_prods = _csr(
+            nsymbols, ((p, s) for s, p, k in occurrences))
+        _, self.occ_positions = _csr(
+            nsymbols, ((k, s) for s, p, k in occurrences))
+        # productions grouped by arity
+        arities = [self.rhs_offsets[p + 1] - self.rhs_offsets[p]
+                   for p in xrange(len(self.productions))]
+        self.max_arity = max(arities) if arities else 0
+        self.arity_offsets, self.arity_prods = _csr(
+            self.max_arity + 1, enumerate(arities))
+
+        self._lhs_productions = {}
+        self._rhs_occurrences = {}
+
+    def used_terminals(self):
+        """
+        Returns the terminals that occur on the right-hand side of some
+        production.
+        """
+        return [self.symbols[s] for s in xrange(len(self.symbols))
+                if self.is_terminal[s] and
+                self.occ_offsets[s + 1] > self.occ_offsets[s]]
+
+    def rhs(self, p):
+        """
+        Returns the interned right-hand side of production p.
+
+        :type p: int
+        :param p: A production id.
+
+        :rtype: list
+        :return: The symbol ids of the right-hand side.
+        """
+        return self.rhs_symbols[self.rhs_offsets[p]:self.rhs_offsets[p + 1]]
+
+    def prods_with_lhs(self, s):
+        """
+        Returns the ids of the productions with symbol id s on the
+        left-hand side.
+        """
+        return self.lhs_prods[self.lhs_offsets[s]:self.lhs_offsets[s + 1]]
+
+    def occurrences_of(self, s):
+        """
+        Returns a list of (production id, position) pairs, one for each
+        occurrence of symbol id s on a right-hand side.
+        """
+        start = self.occ_offsets[s]
+        end = self.occ_offsets[s + 1]
+        return zip(self.occ_prods[start:end], self.occ_positions[start:end])
+
+    def prods_with_arity(self, n):
+        """
+        Returns the ids of the productions with a right-hand side of
+        length n.
+        """
+        if n > self.max_arity:
+            return []
+        return self.arity_prods[self.arity_offsets[n]:self.arity_offsets[n + 1]]
+
+    def lhs_productions(self, symbol):
+        """
+        Returns the productions, as (lhs, rhs) tuples, that have the given
+        symbol on the left-hand side. The list is cached and must not be
+        modified.
+        """
+        if not symbol in self._lhs_productions:
+            s = self.symbol_ids.get(symbol)
+            if s is None:
+                result = []
+            else:
+                result = [self.productions[p] for p in self.prods_with_lhs(s)]
+            self._lhs_productions[symbol] = result
+        return self._lhs_productions[symbol]
+
+    def rhs_occurrences(self, symbol):
+        """
+        Returns a list of (production, position) pairs, one for each
+        occurrence of the given symbol on a right-hand side. The list is
+        cached and must not be modified.
+        """
+        if not symbol in self._rhs_occurrences:
+            s = self.symbol_ids.get(symbol)
+            if s is None:
+                result = []
+            else:
+                result = [(self.productions[p], k)
+                          for p, k in self.occurrences_of(s)]
+            self._rhs_occurrences[symbol] = result
+        return self._rhs_occurrences[symbol]
+
+
+def _csr(ngroups, pairs):
+    """
+    Groups (value, group) pairs into CSR form with a counting sort.
+    Returns the offsets list of length ngroups + 1 and the flat list of
+    values, which keep their original relative order within each group.
+    """
+    pairs = list(pairs)
+    offsets = [0] * (ngroups + 1)
+    for value, group in pairs:
+        offsets[group + 1] += 1
+    for g in xrange(ngroups):
+        offsets[g + 1] += offsets[g]
+    values = [0] * len(pairs)
+    fill = list(offsets)
+    for value, group in pairs:
+        values[fill[group]] = value
+        fill[group] += 1
+    return offsets, values
+
+
 def binarise_production(prod):
     """
     return a list of productions of length 1 if the rhs is less than 3.
@@ -12,6 +12,8 @@
 import cfg
 import uniformsampler
 import earleyparser
+import ckyparser
+import membershipcache
 
 import numpy
 import logging
@@ -28,6 +30,30 @@ number_yields = 10
 # we try max_attempts times.
 max_attempts = 50
 
+# number of membership answers each parser remembers.
+# The attempts for a nonterminal draw overlapping subsets of the same few
+# candidates, so the same strings are parsed over and over.
+membership_cache_size = 100000
+
+# how the samplers count derivations; the counts overflow floats quickly
+# with large vocabularies, so keep them exact.
+sampler_mode = "exact"
+
+# directory where the sampler tables of the grammars are kept between runs,
+# or None to always recompute them.
+sampler_cache_dir = None
+
+def make_parser(grammar):
+	"""
+	Return a recogniser for this grammar: a bitset CKY parser if the grammar
+	is in Chomsky normal form and an Earley parser otherwise.
+	Both remember their answers in an LRU cache.
+	"""
+	cache = membershipcache.MembershipCache(membership_cache_size)
+	if grammar.is_cnf():
+		return ckyparser.CkyParser(grammar, cache=cache)
+	return earleyparser.EarleyParser(grammar, cache=cache)
+
 #
 # FCP code
 #
@@ -38,9 +64,9 @@ def test_strong_fcp_full(grammar, k):
 	Method:
 	"""
 	result = dict()
-	parser = earleyparser.EarleyParser(grammar)
-	sampler = uniformsampler.UniformSampler(grammar, max_substring_length)
-	contextsampler = uniformsampler.ContextSampler(grammar, sampler, max_context_length)
+	parser = make_parser(grammar)
+	sampler = uniformsampler.UniformSampler(grammar, max_substring_length, mode=sampler_mode, cache_dir=sampler_cache_dir)
+	contextsampler = uniformsampler.ContextSampler(grammar, sampler, max_context_length, cache_dir=sampler_cache_dir)
 	ncontexts = 25
 	for nt in grammar.nonterminals:
 		r = test_strong_fcp_nt(grammar, parser, sampler, contextsampler,  nt, k, ncontexts, stop=True)
@@ -49,7 +75,9 @@ def test_strong_fcp_full(grammar, k):
 			result[nt] = r
 		else:
 			print "Fail ", nt
+			logging.info("membership cache %s", parser.cache.stats())
 			return False
+	logging.info("membership cache %s", parser.cache.stats())
 	return result
 
 def test_strong_fcp_nt(grammar, parser, sampler, contextsampler, nt, k, ncontexts, stop = True):
@@ -105,8 +133,8 @@ def test_one_fcp_exact(grammar, ncontexts):
 	"""
 	See if this has the exact 1-fcp. Use ncontexts
 	"""
-	sampler = uniformsampler.UniformSampler(grammar, max_substring_length)
-	contextsampler = uniformsampler.ContextSampler(grammar, sampler, max_context_length)
+	sampler = uniformsampler.UniformSampler(grammar, max_substring_length, mode=sampler_mode, cache_dir=sampler_cache_dir)
+	contextsampler = uniformsampler.ContextSampler(grammar, sampler, max_context_length, cache_dir=sampler_cache_dir)
 	result = dict()
 	#ok = True
 	for nt in grammar.nonterminals:
@@ -127,8 +155,8 @@ def count_one_fcp_exact(grammar, ncontexts):
 	"""
 	See if this has the exact 1-fcp. Use ncontexts
 	"""
-	sampler = uniformsampler.UniformSampler(grammar, max_substring_length)
-	contextsampler = uniformsampler.ContextSampler(grammar, sampler, max_context_length)
+	sampler = uniformsampler.UniformSampler(grammar, max_substring_length, mode=sampler_mode, cache_dir=sampler_cache_dir)
+	contextsampler = uniformsampler.ContextSampler(grammar, sampler, max_context_length, cache_dir=sampler_cache_dir)
 	result = dict()
 	#ok = True
 	for nt in grammar.nonterminals:
@@ -154,14 +182,15 @@ def test_strong_fcp_contexts(grammar, parser,  nonterminal, contexts, nsamples):
 	first_context = contexts[0]
 	(leftpart,rightpart) = first_context
 	totalwidth = len(leftpart) + len(rightpart)
-	ig = grammar.context_grammar_without_nt(first_context, nonterminal)
-	#ig.dump()
-	if ig.is_empty():
+	if grammar.context_witness_without_nt(first_context, nonterminal) is None:
 		#print "Exact FCP success"
 		return True
+	ig = grammar.context_grammar_without_nt(first_context, nonterminal)
+	#ig.dump()
 	# otherwise 
 	sample_strings = pick_some_inside_strings(ig, first_context, nsamples)
 	#print "Sample strings ", len(sample_strings), sample_strings
+	candidates = []
 	for w in sample_strings:
 		#print "W = ", w
 		if len(w) > 0:
@@ -170,16 +199,18 @@ def test_strong_fcp_contexts(grammar, parser,  nonterminal, contexts, nsamples):
 				# ok now this string might be a counterexample
 				# since it is accepted by the first context 
 				# bit not in the yield of the nonterminal. 
-				for l,r in contexts[1:]:
-					lwr = l + tuple(w) + r
-					#print "LWR", lwr
-					if not parser.parse(lwr):
-						#print "Not parsed"
-						break
-				else:
-					#print "accepted by all "
-					logging.info("failed %s" , w)
-					return False
+				candidates.append(tuple(w))
+	# one context at a time, parse the candidates still left in one batch
+	# so that shared prefixes are parsed once, and drop the rejected ones.
+	for l,r in contexts[1:]:
+		if not candidates:
+			return True
+		accepted = parser.parse_many([ l + w + r for w in candidates ])
+		candidates = [ w for w, ok in zip(candidates, accepted) if ok ]
+	if candidates:
+		#print "accepted by all "
+		logging.info("failed %s" , candidates[0])
+		return False
 	return True
 
 def pick_some_inside_strings(igrammar, context, nsamples):
@@ -194,9 +225,10 @@ def pick_some_inside_strings(igrammar, context, nsamples):
 	ll = len(left)
 	lr = len(right)
 	l = len(left) + len(right)
-	sampler = uniformsampler.UniformSampler(igrammar, l + max_substring_length)
-	# this will not generate any strings of length less than l
-	raw =  list(set(sampler.multiple_sample(nsamples, nsamples*2)))
+	# this will not generate any strings of length less than l,
+	# so start short and let the sampler grow as far as it needs.
+	sampler = uniformsampler.UniformSampler(igrammar, l + 1, mode=sampler_mode)
+	raw =  list(set(sampler.multiple_sample(nsamples, nsamples*2, limit=l + max_substring_length)))
 	#print context
 	#print "RAW", raw
 	result = [ x[ll: len(x) -lr] for x in raw ]
@@ -213,15 +245,17 @@ def test_strong_fkp_full(grammar, k):
 	Returns a tuple (True|False, map[ nonterminals to k-tuples of strings ])
 	"""
 	result = dict()
-	parser = earleyparser.EarleyParser(grammar)
-	sampler = uniformsampler.UniformSampler(grammar, max_substring_length)
+	parser = make_parser(grammar)
+	sampler = uniformsampler.UniformSampler(grammar, max_substring_length, mode=sampler_mode, cache_dir=sampler_cache_dir)
 	ncontexts = 25
 	for nt in grammar.nonterminals:
 		r = test_strong_fkp_nt(grammar, parser, sampler, nt, k, ncontexts, stop=True)
 		if r:
 			result[nt] = r
 		else:
+			logging.info("membership cache %s", parser.cache.stats())
 			return False
+	logging.info("membership cache %s", parser.cache.stats())
 	return result
 
 
@@ -231,7 +265,7 @@ def test_one_fkp_exact(grammar, nyields):
 	"""
 	See if this has the exact 1-fkp.
 	"""
-	sampler = uniformsampler.UniformSampler(grammar, max_substring_length)
+	sampler = uniformsampler.UniformSampler(grammar, max_substring_length, mode=sampler_mode, cache_dir=sampler_cache_dir)
 	result = dict()
 	for nt in grammar.nonterminals:
 		w = test_one_fkp_nt_exact(grammar,sampler,nt,nyields)
@@ -264,12 +298,11 @@ def test_one_fcp_nt_context_exact(grammar, nonterminal, context):
 	This is too strong.
 	"""
 	logging.info("Testing context %s", context)
-	ig = grammar.context_grammar_without_nt(context, nonterminal)
-	#ig.dump()
-	if ig.is_empty():
+	witness = grammar.context_witness_without_nt(context, nonterminal)
+	if witness is None:
 		return True
 	else:
-		logging.info("Generates %s", ig.generate_string())
+		logging.info("Generates %s", witness)
 		return False
 
 
@@ -299,8 +332,7 @@ def test_one_fkp_nt_string_exact(grammar, nonterminal, w):
 	Use an over strong condition: test to see if the only occurrences of 
 	w are yields of nonterminal.
 	"""
-	ig = grammar.infix_grammar_without_nt(w, nonterminal)
-	return ig.is_empty()
+	return grammar.infix_witness_without_nt(w, nonterminal) is None
 
 def test_one_fkp_nt_string_inexact(grammar, nonterminal, w, ncontexts):
 	"""
@@ -313,7 +345,7 @@ def test_one_fkp_nt_string_inexact(grammar, nonterminal, w, ncontexts):
 	if ig.is_empty():
 		return True
 	# it is noempty so sample
-	sampler = uniformsampler.UniformSampler(ig, max_substring_length)
+	sampler = uniformsampler.UniformSampler(ig, max_substring_length, mode=sampler_mode)
 	samples = sampler.multiple_sample(ncontexts, ncontexts ** 2)
 	contexts = []
 	for lwr in set(samples):
@@ -406,9 +438,15 @@ def pick_some_contexts(grammar, sampler, contextsampler, nonterminal, n):
 			break
 	if total == 0:
 		raise ValueError("no short contexts at all of nonterminal.")
-	# now we 
-	distribution = [x / total for x in counts]
 	max_attempts = n * n
+	if total <= max_attempts:
+		# few enough to list them all rather than sample.
+		candidates = set()
+		for length in lengths:
+			candidates.update(contextsampler.enumerate_contexts(nonterminal, length))
+		return pick_from(result, candidates, n)
+	# now we 
+	distribution = uniformsampler.normalise(counts)
 	# by sampling from these we will end up with a distribution
 	# that is mostly long.
 	clengths = numpy.random.choice(lengths, max_attempts, p=distribution )
@@ -430,11 +468,10 @@ def pick_some_yields(grammar, sampler, nonterminal, n):
 	"""
 	result = set()
 	# make sure we get the easy ones too.
-	for prod in grammar.productions:
-		if prod[0] == nonterminal:
-			if grammar.is_terminal_production(prod):
-				logging.info("adding lexical rule %s -> %s" % (nonterminal, prod[1]))
-				result.add(prod[1])
+	for prod in grammar.get_index().lhs_productions(nonterminal):
+		if grammar.is_terminal_production(prod):
+			logging.info("adding lexical rule %s -> %s" % (nonterminal, prod[1]))
+			result.add(prod[1])
 	# pick some lengths
 	total = 0
 	lengths = []
@@ -449,15 +486,25 @@ def pick_some_yields(grammar, sampler, nonterminal, n):
 			break
 	if total == 0:
 		raise ValueError("no short yields of nonterminal.")
-	# now we 
-	distribution = [x / total for x in counts]
 	max_attempts = n * n
+	if total <= max_attempts:
+		# few enough to list them all rather than sample.
+		candidates = set()
+		for length in lengths:
+			candidates.update(sampler.enumerate_yields_from(nonterminal, length))
+		return pick_from(result, candidates, n)
+	# now we 
+	distribution = uniformsampler.normalise(counts)
 	# by sampling from these we will end up with a distribution
 	# that is mostly long.
 	clengths = numpy.random.choice(lengths, max_attempts, p=distribution )
-	for length in clengths:
-		w = sampler.sample_from_nonterminal(nonterminal = nonterminal, length=length).collectYield()
-		result.add(tuple(w))
+	if sampler.mode == "exact":
+		# never draw the same derivation twice
+		samples = sampler.sample_without_replacement(nonterminal, clengths)
+	else:
+		samples = (sampler.sample_yield_from(nonterminal, length) for length in clengths)
+	for w in samples:
+		result.add(w)
 		if len(result) >= n:
 			return result
 
@@ -465,6 +512,17 @@ def pick_some_yields(grammar, sampler, nonterminal, n):
 
 
 
+def pick_from(result, candidates, n):
+	"""
+	Add candidates chosen at random to the set result until it has n elements,
+	or there are no more.
+	"""
+	candidates = list(candidates - result)
+	for i in numpy.random.permutation(len(candidates))[:max(0, n - len(result))]:
+		result.add(candidates[i])
+	return result
+
+
 def test_strong_fkp_strings(grammar, parser, nonterminal, strings, ncontexts):
 	"""
 	Test whether these strings are a good characterisation of this nonterminal.
@@ -484,15 +542,16 @@ def intersect_strings(grammar, strings, parser,ncontexts):
 	print "testing string", base
 	contexts = sample_from_substring(grammar,base,ncontexts)
 	
-	results = set()
-	for context in contexts:
-		for w in strings[1:]:
-			lwr = context[0] + tuple(w) + context[1]
-			#print lwr
-			if not parser.parse(lwr):
-				break
-		else:
-			results.add(context)
+	# one string at a time, parse it in the contexts still left in one
+	# batch, and drop the contexts that reject it.
+	contexts = list(contexts)
+	for w in strings[1:]:
+		if not contexts:
+			break
+		w = tuple(w)
+		accepted = parser.parse_many([ context[0] + w + context[1] for context in contexts ])
+		contexts = [ context for context, ok in zip(contexts, accepted) if ok ]
+	results = set(contexts)
 	print "intersected strings", len(results)
 	return results
 
@@ -506,11 +565,14 @@ def sample_from_substring(grammar, w, n):
 	infixgrammar = grammar.infix_grammar(w)
 	
 	max_length = 10
-	sampler = uniformsampler.UniformSampler(infixgrammar, len(w) + max_context_length)
+	# grow the sampler as the lengths are needed.
+	sampler = uniformsampler.UniformSampler(infixgrammar, len(w) + 1, mode=sampler_mode)
 	total = 0
 	counts = []
 	lengths = []
 	for i in xrange(len(w), len(w) + max_context_length):
+		if i > sampler.max_length:
+			sampler.extend_to(min(len(w) + max_context_length, 2 * sampler.max_length))
 		c = sampler.get_total(i)
 		counts.append(c)
 		lengths.append(i)
@@ -522,10 +584,10 @@ def sample_from_substring(grammar, w, n):
 		logging.warning("Sparse contexts")
 	max_attempts = n * n
 	result = set()
-	distribution = [x / total for x in counts]
+	distribution = uniformsampler.normalise(counts)
 	clengths = numpy.random.choice(lengths, max_attempts, p=distribution )
 	for l in clengths:
-		lwr = sampler.sample(l).collectYield()
+		lwr = sampler.sample_yield(l)
 		for context in extract(lwr,w):
 			result.add(context)
 		if len(result) >= n:
@@ -0,0 +1,147 @@
+import collections
+import argparse
+
+import cfg
+
+
+class CkyParser:
+	"""
+	CKY recogniser for grammars in Chomsky normal form, i.e. where every
+	production is A -> B C or A -> a.
+
+	Each chart cell is an integer used as a bitset over the nonterminals.
+	The binary productions are compiled into a map from the bit of B to a
+	list of (bit of C, mask of all A with A -> B C) pairs, so a cell is
+	filled by a few integer operations per split point.
+	Same interface and semantics as the recognition methods of EarleyParser.
+	"""
+
+	def __init__(self, grammar, cache=None):
+		if grammar == None:
+			raise ValueError("can't parse without a grammar.")
+		if not grammar.is_cnf():
+			raise ValueError("grammar is not in Chomsky normal form.")
+		self.grammar = grammar
+		# optional membershipcache.MembershipCache for the answers
+		self.cache = cache
+		if cache is not None:
+			self.fingerprint = grammar.fingerprint()
+		index = grammar.get_index()
+		self.nonterminals = index.symbols[:index.number_nonterminals]
+		self.bits = dict()
+		for i, nt in enumerate(self.nonterminals):
+			self.bits[nt] = 1 << i
+		self.start_mask = 0
+		for s in grammar.start_set:
+			self.start_mask |= self.bits.get(s, 0)
+		# map from terminals to the mask of their preterminals.
+		self.lexical = collections.defaultdict(int)
+		pairs = collections.defaultdict(int)
+		for (lhs, rhs) in grammar.productions:
+			if len(rhs) == 1:
+				self.lexical[rhs[0]] |= self.bits[lhs]
+			else:
+				pairs[(self.bits[rhs[0]], self.bits[rhs[1]])] |= self.bits[lhs]
+		self.binary = collections.defaultdict(list)
+		for (b, c), mask in pairs.iteritems():
+			self.binary[b].append((c, mask))
+		self.binary = dict(self.binary)
+		self.lexical = dict(self.lexical)
+
+	def _leaf(self, token):
+		"""
+		As in the Earley parser, a nonterminal in the input matches itself.
+		"""
+		return self.lexical.get(token, 0) | self.bits.get(token, 0)
+
+	def recognise(self, input_tuple):
+		"""
+		Return the bitset of the nonterminals that derive the whole input.
+		"""
+		n = len(input_tuple)
+		if n == 0:
+			return 0
+		if n == 1:
+			# a nonterminal token is only ever consumed by a larger constituent.
+			return self.lexical.get(input_tuple[0], 0)
+		# chart[i][j] is the cell for the span i..j
+		chart = [ [0] * (n + 1) for i in xrange(n + 1) ]
+		for i in xrange(n):
+			leaf = self._leaf(input_tuple[i])
+			if leaf == 0:
+				# no parse can cover this token.
+				return 0
+			chart[i][i + 1] = leaf
+		binary = self.binary
+		for width in xrange(2, n + 1):
+			for i in xrange(n - width + 1):
+				j = i + width
+				row = chart[i]
+				cell = 0
+				for k in xrange(i + 1, j):
+					left = row[k]
+					right = chart[k][j]
+					if left == 0 or right == 0:
+						continue
+					while left:
+						b = left & -left
+						left ^= b
+						for c, mask in binary.get(b, ()):
+							if right & c:
+								cell |= mask
+				row[j] = cell
+		return chart[0][n]
+
+	def parse(self, input_tuple):
+		"""
+		Takes as input a tuple and parses it.
+		Returns True or False
+		"""
+		if self.cache is not None:
+			key = (self.fingerprint, "parse", tuple(input_tuple))
+			return self.cache.get(key, lambda: self._parse(input_tuple))
+		return self._parse(input_tuple)
+
+	def _parse(self, input_tuple):
+		return (self.recognise(input_tuple) & self.start_mask) != 0
+
+	def parse_many(self, strings):
+		"""
+		Parse a list of tuples and return a list of True or False, one for each.
+		"""
+		return [ self.parse(tuple(w)) for w in strings ]
+
+	def parse_start(self, input_tuple, nonterminal):
+		"""
+		Parse this using the given nonterminal as a start symbol.
+		"""
+		if self.cache is not None:
+			key = (self.fingerprint, "parse_start", tuple(input_tuple), nonterminal)
+			return self.cache.get(key, lambda: self._parse_start(input_tuple, nonterminal))
+		return self._parse_start(input_tuple, nonterminal)
+
+	def _parse_start(self, input_tuple, nonterminal):
+		return (self.recognise(input_tuple) & self.bits.get(nonterminal, 0)) != 0
+
+	def parse_nonterminal_context(self, left, nonterminal, right):
+		"""
+		Return true if a start symbol parses lAr.
+		"""
+		if self.cache is not None:
+			key = (self.fingerprint, "parse_nonterminal_context", tuple(left), nonterminal, tuple(right))
+			return self.cache.get(key, lambda: self._parse(left + (nonterminal,) + right))
+		return self._parse(left + (nonterminal,) + right)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="""
+			Interactive CKY recogniser for a CFG in Chomsky normal form.
+		""")
+	parser.add_argument("grammar", help="File containing the cfg")
+	args = parser.parse_args()
+
+	grammar = cfg.load_from_file(args.grammar)
+	parser = CkyParser(grammar)
+	while True:
+		line = raw_input("Type in line:")
+		print parser.parse(tuple(line.split()))
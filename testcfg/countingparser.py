@@ -0,0 +1,173 @@
+import collections
+
+import cfg
+import tarjan
+
+# the count of a symbol over a span with infinitely many derivations.
+infinite = float("inf")
+
+
+def _add(x, y):
+	if x == infinite or y == infinite:
+		return infinite
+	return x + y
+
+def _mul(x, y):
+	if x == 0 or y == 0:
+		return 0
+	if x == infinite or y == infinite:
+		return infinite
+	return x * y
+
+
+class CountingParser:
+	"""
+	Counts the derivations of a string with an inside pass over the spans,
+	without building a parse forest.
+
+	The grammar is binarised. For every span the binary productions with
+	two non-empty daughters are combined first; then the unary productions
+	and the binary ones with a nullable daughter, which stay inside the
+	span, are added with every symbol finished before it is used. If such
+	productions form a loop, the symbols in it get an infinite count.
+
+	Counts are exact Python ints.
+	"""
+
+	def __init__(self, grammar):
+		if grammar == None:
+			raise ValueError("can't parse without a grammar.")
+		self.grammar = grammar
+		productions = []
+		for prod in grammar.productions:
+			productions.extend(cfg.binarise_production(prod))
+		self.productions = productions
+		self.empty = self._count_empty()
+		# map from the first daughter to (second daughter, lhs) pairs
+		self.binary = collections.defaultdict(list)
+		# map from each symbol to the (daughter, weight) pairs in the same span
+		self.same_span = collections.defaultdict(list)
+		for lhs, rhs in productions:
+			if len(rhs) == 1:
+				self.same_span[lhs].append((rhs[0], 1))
+			elif len(rhs) == 2:
+				one, two = rhs
+				self.binary[one].append((two, lhs))
+				if self.empty.get(one, 0):
+					self.same_span[lhs].append((two, self.empty[one]))
+				if self.empty.get(two, 0):
+					self.same_span[lhs].append((one, self.empty[two]))
+		self.binary = dict(self.binary)
+		self.same_span = dict(self.same_span)
+		self.order = self._components(self.same_span)
+
+	def _components(self, graph):
+		"""
+		The strongly connected components of graph, a map from symbols to
+		(daughter, weight) pairs, with every symbol after the ones it
+		depends on, and whether each one is a loop.
+		"""
+		successors = dict((x, [ y for y, w in pairs ]) for x, pairs in graph.iteritems())
+		result = []
+		for scc in tarjan.strongly_connected_components(successors):
+			loop = len(scc) > 1 or scc[0] in successors.get(scc[0], ())
+			result.append((scc, loop))
+		return result
+
+	def _count_empty(self):
+		"""
+		Number of derivations of the empty string from each symbol.
+		"""
+		binarised = cfg.ContextFreeGrammar()
+		binarised.productions = set(self.productions)
+		nullable = binarised.compute_nullable()
+		graph = collections.defaultdict(list)
+		empty_productions = collections.defaultdict(list)
+		for lhs, rhs in self.productions:
+			if all(x in nullable for x in rhs):
+				graph[lhs].extend((x, 1) for x in rhs)
+				empty_productions[lhs].append(rhs)
+		counts = dict()
+		for scc, loop in self._components(dict(graph)):
+			for x in scc:
+				if loop:
+					counts[x] = infinite
+				else:
+					counts[x] = 0
+			if loop:
+				continue
+			x = scc[0]
+			for rhs in empty_productions[x]:
+				product = 1
+				for y in rhs:
+					product = _mul(product, counts[y])
+				counts[x] = _add(counts[x], product)
+		return counts
+
+	def _close(self, base):
+		"""
+		Add the derivations that stay inside the span to the counts in base.
+		"""
+		counts = dict()
+		for scc, loop in self.order:
+			values = []
+			for x in scc:
+				value = base.get(x, 0)
+				for y, weight in self.same_span.get(x, ()):
+					if y in counts:
+						value = _add(value, _mul(weight, counts[y]))
+				values.append(value)
+			if loop and any(values):
+				values = [ infinite ] * len(scc)
+			for x, value in zip(scc, values):
+				if value:
+					counts[x] = value
+		# symbols that nothing in the span depends on
+		for x, value in base.iteritems():
+			if value and not x in counts and not x in self.same_span:
+				counts[x] = value
+		return counts
+
+	def inside(self, input_tuple):
+		"""
+		Return the chart: a map from spans (i, j) to maps from symbols
+		to their numbers of derivations of input_tuple[i:j].
+		"""
+		n = len(input_tuple)
+		binary = self.binary
+		chart = dict()
+		for width in xrange(1, n + 1):
+			for i in xrange(n - width + 1):
+				j = i + width
+				base = collections.defaultdict(int)
+				if width == 1:
+					base[input_tuple[i]] = 1
+				for k in xrange(i + 1, j):
+					left = chart[(i, k)]
+					right = chart[(k, j)]
+					if not left or not right:
+						continue
+					for one, x in left.iteritems():
+						for two, lhs in binary.get(one, ()):
+							y = right.get(two, 0)
+							if y:
+								base[lhs] = _add(base[lhs], _mul(x, y))
+				chart[(i, j)] = self._close(base)
+		return chart
+
+	def count_parses(self, input_tuple):
+		"""
+		Return the number of derivations of input_tuple from the start
+		symbols, or -1 if there are infinitely many.
+		"""
+		n = len(input_tuple)
+		if n == 0:
+			counts = self.empty
+		else:
+			counts = self.inside(input_tuple)[(0, n)]
+		total = 0
+		for s in self.grammar.start_set:
+			total = _add(total, counts.get(s, 0))
+		if total == infinite:
+			return -1
+		return total
@@ -10,6 +10,10 @@ import forest
 
 time_parser = False
 
+# Item level tracing through the logging module. Off by default: when it
+# is off the hot loops pay for one boolean test and never build strings.
+trace_parser = False
+
 
 # item format = 
 # (lhs, rhs, position, start, end)
@@ -45,17 +49,35 @@ class EarleyParser:
 	Implementation of Earley style parser for arbitrary CFGs.
 	Incremental, left to right.
 	Items are coded as (lhs,rhs, rhsposition, start,end) tuples.
+
+	In indexed mode (the default) prediction looks up the productions of
+	the predicted nonterminal in a precomputed table, and each chart
+	column keeps the incomplete items bucketed by the category they are
+	waiting for, so that completion only visits the items it can extend.
 	"""
 
-	def __init__(self, grammar):
+	def __init__(self, grammar, indexed=True, cache=None):
 		if grammar == None:
 			raise ValueError("can't parse without a grammar.")
 		self.grammar = grammar
+		self.indexed = indexed
+		# optional membershipcache.MembershipCache for the answers
+		self.cache = cache
+		if cache is not None:
+			self.fingerprint = grammar.fingerprint()
 		# other initialisations here,
 		# including any necessary precomputations on the grammar.
 		self.nullable = grammar.compute_nullable()
+		index = grammar.get_index()
+		self.lhs_table = dict()
+		for nt in index.symbols[:index.number_nonterminals]:
+			self.lhs_table[nt] = index.lhs_productions(nt)
 		self.chart = []
 		self.chart_set = []
+		# per column, map from categories to the items waiting for them
+		self.waiting = []
+		# per column, map from categories to their completed empty items
+		self.empty = []
 		# map from items to previous states
 		self.previous_states = collections.defaultdict(list)
 		self.reduced_states = collections.defaultdict(list)
@@ -66,44 +88,64 @@ class EarleyParser:
 	def _init_chart(self, length):
 		self.chart = []
 		self.chart_set = []
+		self.waiting = []
+		self.empty = []
 		self.length = length
 		self.previous_states = collections.defaultdict(list)
 		self.reduced_states = collections.defaultdict(list)
 		for i in range(length+1):
 			self.chart_set.append(set())
 			self.chart.append(collections.deque())
+			self.waiting.append(collections.defaultdict(list))
+			self.empty.append(collections.defaultdict(list))
+
+	def _productions(self, nonterminal):
+		"""
+		The productions with this nonterminal on the left hand side.
+		"""
+		if self.indexed:
+			return self.lhs_table.get(nonterminal, ())
+		return [ prod for prod in self.grammar.productions if prod[0] == nonterminal ]
 
 	def _initialise_state_sets(self,length):
 		self._init_chart(length)
-		for prod in self.grammar.productions:
-			if prod[0] in self.grammar.start_set:
+		for start in self.grammar.start_set:
+			for prod in self._productions(start):
 				self.enqueue((prod[0],prod[1],0,0,0))
 
 	def _initialise_state_sets_nt(self,length, nonterminal):
 		self._init_chart(length)
-		for prod in self.grammar.productions:
-			if prod[0] == nonterminal:
-				self.enqueue((prod[0],prod[1],0,0,0))
+		for prod in self._productions(nonterminal):
+			self.enqueue((prod[0],prod[1],0,0,0))
 
 
 	def parse_nonterminal_context(self, left, nonterminal, right):
 		"""
 		Return true if a start symbol parses lAr.
 		"""
+		if self.cache is not None:
+			key = (self.fingerprint, "parse_nonterminal_context", tuple(left), nonterminal, tuple(right))
+			return self.cache.get(key, lambda: self._parse_nonterminal_context(left, nonterminal, right))
+		return self._parse_nonterminal_context(left, nonterminal, right)
+
+	def _parse_nonterminal_context(self, left, nonterminal, right):
 		input_tuple = left + (nonterminal,) + right
 		self.input = input_tuple
 		length = len(input_tuple)
-		logging.info("Parse nonterminal context %d ", str(length))
+		if trace_parser:
+			logging.info("Parse nonterminal context %d ", length)
 		self._initialise_state_sets(length)
 		# now add the 
 		#item = (nonterminal, (), 0, len(left), len(left)+ 1)
 		#self.add_to_chart(item)
 		self.process()
 		for x in self.chart[length]:
-			logging.info("Checking %s", to_string(x))
+			if trace_parser:
+				logging.info("Checking %s", to_string(x))
 			if is_complete(x) and x[3] == 0 and x[0] in self.grammar.start_set:
 				return True
-		logging.info("No parse found.")
+		if trace_parser:
+			logging.info("No parse found.")
 		return False
 
 
@@ -112,11 +154,18 @@ class EarleyParser:
 		"""
 		Parse this using the given nonterminal as a start symbol.
 		"""
+		if self.cache is not None:
+			key = (self.fingerprint, "parse_start", tuple(input_tuple), nonterminal)
+			return self.cache.get(key, lambda: self._parse_start(input_tuple, nonterminal))
+		return self._parse_start(input_tuple, nonterminal)
+
+	def _parse_start(self, input_tuple, nonterminal):
 		self._initialise_state_sets_nt(len(input_tuple),nonterminal)
 		self.input = input_tuple
 		self.process()
 		for x in self.chart[len(input_tuple)]:
-			logging.info("Checking %s", to_string(x))
+			if trace_parser:
+				logging.info("Checking %s", to_string(x))
 			if is_complete(x) and x[3] == 0 and x[0] == nonterminal:
 				return True
 		return False
@@ -127,34 +176,120 @@ class EarleyParser:
 		Returns True or False
 
 		"""
+		if self.cache is not None:
+			key = (self.fingerprint, "parse", tuple(input_tuple))
+			return self.cache.get(key, lambda: self._parse(input_tuple))
+		return self._parse(input_tuple)
+
+	def _parse(self, input_tuple):
 		t0 = time.time()
 		self._initialise_state_sets(len(input_tuple))
 		self.input = input_tuple
 		self.process()
 		t1 = time.time()
-		logging.info("Finished parsing")
+		if trace_parser:
+			logging.info("Finished parsing")
 		if time_parser:
 			logging.warning("Parse: l = %d, t = %f" % (len(input_tuple), t1-t0))
-		for x in self.chart[len(input_tuple)]:
-			logging.info("Checking for complete %s", to_string(x))
+		return self._accepted(len(input_tuple))
+
+	def _accepted(self, length):
+		"""
+		Return true if the chart has a complete item for a start symbol
+		spanning the first length symbols.
+		"""
+		for x in self.chart[length]:
+			if trace_parser:
+				logging.info("Checking for complete %s", to_string(x))
 			if is_complete(x) and x[3] == 0 and x[0] in self.grammar.start_set:
 				return True
 		return False	
 
+	def parse_many(self, strings):
+		"""
+		Parse a list of tuples and return a list of True or False, one for each.
+
+		Column i of an Earley chart only depends on the first i symbols, so
+		we parse the strings in sorted order and keep the columns for
+		the prefix shared with the previous string.
+		"""
+		if self.cache is None:
+			return self._parse_many(strings)
+		result = [None] * len(strings)
+		keys = [ (self.fingerprint, "parse", tuple(w)) for w in strings ]
+		missing = []
+		for i, key in enumerate(keys):
+			result[i] = self.cache.lookup(key)
+			if result[i] is None:
+				missing.append(i)
+		answers = self._parse_many([ strings[i] for i in missing ])
+		for i, answer in zip(missing, answers):
+			self.cache.put(keys[i], answer)
+			result[i] = answer
+		return result
+
+	def _parse_many(self, strings):
+		result = [False] * len(strings)
+		order = sorted(xrange(len(strings)), key=lambda i: strings[i])
+		previous = None
+		for i in order:
+			input_tuple = tuple(strings[i])
+			if previous is None:
+				self._initialise_state_sets(len(input_tuple))
+				self.input = input_tuple
+				self.process()
+			else:
+				shared = 0
+				limit = min(len(previous), len(input_tuple))
+				while shared < limit and previous[shared] == input_tuple[shared]:
+					shared += 1
+				self._resume(input_tuple, shared)
+			result[i] = self._accepted(len(input_tuple))
+			previous = input_tuple
+		return result
+
+	def _resume(self, input_tuple, shared):
+		"""
+		Reuse columns 0..shared of the current chart, which must
+		have been built for an input that agrees with this one on the first
+		shared symbols, and complete the chart for input_tuple.
+		"""
+		for column in self.chart[shared + 1:]:
+			for item in column:
+				self.previous_states.pop(item, None)
+				self.reduced_states.pop(item, None)
+		del self.chart[shared + 1:]
+		del self.chart_set[shared + 1:]
+		del self.waiting[shared + 1:]
+		del self.empty[shared + 1:]
+		self.length = len(input_tuple)
+		self.input = input_tuple
+		for i in xrange(shared + 1, self.length + 1):
+			self.chart_set.append(set())
+			self.chart.append(collections.deque())
+			self.waiting.append(collections.defaultdict(list))
+			self.empty.append(collections.defaultdict(list))
+		# the items of the last shared column have to scan the new symbol
+		for item in self.chart[shared]:
+			if not is_complete(item):
+				self.scanner(item)
+		self.process(shared + 1)
+
 
 	def count_parses(self, input_tuple):
-		print "parse started"
-		roots = self.parse_forest(input_tuple)
-		print "parse ended"
-		logging.info("Parsed ok, now counting	")
+		"""
+		Count the trees in the parse forest; -1 if there are infinitely many.
+		countingparser.CountingParser does this without building the forest.
+		"""
+		compact = self.parse_compact_forest(input_tuple)
+		if trace_parser:
+			logging.info("Parsed ok, now counting	")
 		total = 0
-		if not roots:
-			return total
-		for x in roots:
-			n = x.count_trees()
+		for x in compact.roots:
+			n = compact.count_trees(x)
 			if n < 0:
 				return -1
-			total += x.count_trees()
+			total += n
 		return total
 
 
@@ -169,9 +304,11 @@ class EarleyParser:
 		builder = forest.ForestBuilder(self.input, self.grammar,self)
 		roots = set()
 		for x in self.chart[l]:
-			logging.info("Checking %s", to_string(x))
+			if trace_parser:
+				logging.info("Checking %s", to_string(x))
 			if is_complete(x) and x[3] == 0 and x[0] in self.grammar.start_set:
-				logging.info("Found root node %s", to_string(x))
+				if trace_parser:
+					logging.info("Found root node %s", to_string(x))
 				u = builder.get_node(0,l,x[0])
 				builder.build_tree(u,x)
 				roots.add(u)
@@ -180,20 +317,39 @@ class EarleyParser:
 
 		return list(roots)
 
-	def process(self):
+	def parse_compact_forest(self, input_tuple):
+		"""
+		Return the same forest as parse_forest as a forest.CompactForest,
+		whose roots are the ids of the root nodes.
+		"""
+		self._initialise_state_sets(len(input_tuple))
+		self.input = input_tuple
+		l = len(self.input)
+		self.process()
+		result = forest.CompactForest(self.input, self.grammar, self)
+		roots = [ x for x in self.chart[l]
+			if is_complete(x) and x[3] == 0 and x[0] in self.grammar.start_set ]
+		result.build(roots)
+		result.roots = sorted(set(result.roots))
+		return result
+
+	def process(self, begin=0):
 		"""
 		Loop through until agenda is empty.
+		Columns before begin are assumed to be complete already.
 		"""
 		t0 = time.time()
-		for i in xrange(self.length + 1):
+		for i in xrange(begin, self.length + 1):
 			chartx = self.chart[i]
 			j = 0
 			while j < len(chartx):
 				item = chartx[j]
 				j = j+1
-				logging.info("Processing %s", to_string(item))
+				if trace_parser:
+					logging.info("Processing %s", to_string(item))
 				if is_complete(item):
-					logging.info("Complete item")
+					if trace_parser:
+						logging.info("Complete item")
 					self.completer(item)
 				else:
 					next = next_category(item)
@@ -215,14 +371,21 @@ class EarleyParser:
 		"""
 		position = item[3]
 		label = item[0]
+		if position == item[4]:
+			# for the items that skip over label later; see predictor
+			self.empty[position][label].append(item)
 		
 		#for other_item in self.chart[position]:
-		chartx = self.chart[position]
+		if self.indexed:
+			chartx = self.waiting[position].get(label, ())
+		else:
+			chartx = self.chart[position]
 		i = 0
 		while i < len(chartx):
 			other_item = chartx[i]
 			i += 1
-			logging.info("Matching with %s ", to_string(other_item))
+			if trace_parser:
+				logging.info("Matching with %s ", to_string(other_item))
 			if not is_complete(other_item):
 				if next_category(other_item) == label:
 					## match!
@@ -232,7 +395,8 @@ class EarleyParser:
 					self.reduced_states[new_item].append(item)
 					if other_item[2]> 0:
 						self.previous_states[new_item].append(other_item)
-					logging.info("Creating new item  %s ", to_string(new_item))
+					if trace_parser:
+						logging.info("Creating new item  %s ", to_string(new_item))
 					self.enqueue(new_item)
 
 	def enqueue(self,item):
@@ -243,6 +407,8 @@ class EarleyParser:
 		if not item in self.chart_set[pos]:
 			self.chart_set[pos].add(item)
 			self.chart[pos].append(item)
+			if self.indexed and not is_complete(item):
+				self.waiting[pos][next_category(item)].append(item)
 
 
 
@@ -257,16 +423,19 @@ class EarleyParser:
 		Incomplete item looking for a terminal.
 		"""
 		terminal = next_category(item)
-		logging.info("Scanning %s", terminal)
+		if trace_parser:
+			logging.info("Scanning %s", terminal)
 		if item[4] >= len(self.input):
-			logging.info("End of string")
+			if trace_parser:
+				logging.info("End of string")
 			return False
 		if terminal == self.input[item[4]]:
 			# match
 
 					
 			new_item = (item[0],item[1],item[2]+1,item[3],item[4]+1)
-			#self.previous_states[new_item].append((terminal,item))
+			if item[2] > 0:
+				self.previous_states[new_item].append(item)
 			#rint "appending", terminal, "to", to_string(new_item)
 			self.enqueue(new_item)
 			return True
@@ -277,16 +446,24 @@ class EarleyParser:
 		"""
 		nonterminal = next_category(item)
 		if nonterminal in self.nullable:
-			logging.info("Nullable item %s", nonterminal)
+			if trace_parser:
+				logging.info("Nullable item %s", nonterminal)
 			# Aycock and Horspool
 			new_item = (item[0],item[1],item[2]+1, item[3],item[4])
+			# record the empty constituents completed so far, so that the
+			# forest has them; the completer pairs this item with the rest.
+			reduced = self.reduced_states[new_item]
+			for complete_item in self.empty[item[4]][nonterminal]:
+				if not complete_item in reduced:
+					reduced.append(complete_item)
+			if item[2] > 0 and not item in self.previous_states[new_item]:
+				self.previous_states[new_item].append(item)
 			self.enqueue(new_item)
-		for prod in self.grammar.productions:
-			if prod[0] == nonterminal:
-
-				new_item = (prod[0],prod[1],0,item[4],item[4])
+		for prod in self._productions(nonterminal):
+			new_item = (prod[0],prod[1],0,item[4],item[4])
+			if trace_parser:
 				logging.info("Predicting %s", to_string(new_item))
-				self.enqueue(new_item)
+			self.enqueue(new_item)
 		
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description="""
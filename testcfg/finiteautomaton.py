@@ -1,4 +1,6 @@
 #import pcfg
+import collections
+
 import cfg
 #import partitionfunction
 
@@ -14,6 +16,11 @@ class FiniteAutomaton:
 		self.end = set()
 		self.states = set()
 		self.arcs = set()	
+		# arcs that accept a class of symbols: tuples (start, end, excluded)
+		# which accept any symbol of the alphabet that is not in the
+		# frozenset excluded.
+		self.class_arcs = set()
+		self.alphabet = frozenset()
 		self.initial = False
 		self.final = False
 
@@ -22,11 +29,37 @@ class FiniteAutomaton:
 		self.states.add(i)
 		self.states.add(j)
 
+	def addAnyArc(self, i, j, excluded=()):
+		"""
+		Add an arc that accepts any symbol of self.alphabet except those in excluded.
+		An arc that would accept nothing is not added.
+		"""
+		excluded = frozenset(excluded)
+		if self.alphabet.issubset(excluded):
+			return
+		self.class_arcs.add((i,j,excluded))
+		self.states.add(i)
+		self.states.add(j)
+
+	def expanded_arcs(self, symbols):
+		"""
+		Return the arcs as (start, end, symbol) tuples, with each class arc
+		expanded over those of the given symbols that it accepts.
+		"""
+		result = list(self.arcs)
+		for (i, j, excluded) in self.class_arcs:
+			for s in symbols:
+				if s in self.alphabet and not s in excluded:
+					result.append((i, j, s))
+		return result
+
 	def dump(self):
 		print "start states ", self.start
 		print "end states ", self.end
 		for a in self.arcs:
 			print a[0], "->", a[1], ": ", a[2]
+		for a in self.class_arcs:
+			print a[0], "->", a[1], ": any except", list(a[2])
 
 	def getNonTerminal(self,i,j,s,map):
 		"""
@@ -83,11 +116,15 @@ class FiniteAutomaton:
 		return answer
 
 
-	def intersect_cfg_remove(self, grammar, nonterminal):
+	def intersect_cfg_remove(self, grammar, nonterminal, pruned=False):
 		"""
 		Return a cfg and remove the states that will generate
 		(nonterminal, self.initial, self.final)
+
+		If pruned is true the result is trim; see intersect_cfg.
 		"""
+		if pruned:
+			return self._intersect_cfg_pruned(grammar, dict(), nonterminal)
 		ntmap = dict()
 		cfg = self.intersect_cfg(grammar,ntmap)
 		special_nonterminal = self.getNonTerminal2(self.initial,self.final, nonterminal,ntmap)
@@ -105,14 +142,22 @@ class FiniteAutomaton:
 
 
 
-	def intersect_cfg(self, grammar, ntmap=False):
+	def intersect_cfg(self, grammar, ntmap=False, pruned=False):
 		"""
 		Return a new cfg.
+
+		If pruned is true, only the nonterminals (i, A, j) that both
+		derive a string bottom-up and are reachable from a start
+		nonterminal are constructed. The result is then the same grammar
+		as intersect_cfg(grammar).trim(), but the useless part of the
+		product is never built.
 		"""
+		if ntmap is False:
+			ntmap = dict()
+		if pruned:
+			return self._intersect_cfg_pruned(grammar, ntmap)
 		newgrammar = cfg.ContextFreeGrammar()
 		productions = set()
-		if not ntmap:
-			ntmap = dict()
 		for start_nt in grammar.start_set:
 			newgrammar.nonterminals.add(start_nt)
 		# unary rules from start symbol to start_state,end_state, start_symbol
@@ -122,8 +167,8 @@ class FiniteAutomaton:
 					nt = self.getNonTerminal2(start_state,end_state,start_nt,ntmap)
 					production = (start_nt,(nt,))
 					productions.add(production)
-		# lexical rules
-		for arc in self.arcs:
+		# lexical rules; class arcs only for the terminals the grammar uses
+		for arc in self.expanded_arcs(grammar.get_index().used_terminals()):
 			lhs = self.getNonTerminal2(arc[0],arc[1],arc[2],ntmap)
 			production = (lhs, (arc[2],))
 			productions.add(production)
@@ -160,6 +205,69 @@ class FiniteAutomaton:
 		newgrammar.start_set = set(grammar.start_set)
 		return newgrammar
 
+	def _intersect_cfg_pruned(self, grammar, ntmap, excluded_nt=None):
+		"""
+		Derive all the triples bottom-up, then walk top-down from the
+		start triples, expanding each production only through sequences
+		of states whose triples have been derived.
+		"""
+		chart = _ProductChart(self, grammar, excluded_nt)
+		chart.run()
+		index = chart.index
+		symbols = index.symbols
+		newgrammar = cfg.ContextFreeGrammar()
+		productions = set()
+		agenda = []
+		done = set()
+		for goal in chart.goals:
+			if goal in chart.triples:
+				start_nt = symbols[goal[1]]
+				nt = self.getNonTerminal2(goal[0], goal[2], start_nt, ntmap)
+				productions.add((start_nt, (nt,)))
+				newgrammar.start_set.add(start_nt)
+				newgrammar.nonterminals.add(start_nt)
+				if not goal in done:
+					done.add(goal)
+					agenda.append(goal)
+		while agenda:
+			(i, s, j) = agenda.pop()
+			lhs = self.getNonTerminal2(i, j, symbols[s], ntmap)
+			newgrammar.nonterminals.add(lhs)
+			if index.is_terminal[s]:
+				# lexical rule from an arc
+				productions.add((lhs, (symbols[s],)))
+				newgrammar.terminals.add(symbols[s])
+				continue
+			for p in index.prods_with_lhs(s):
+				rhs = index.rhs(p)
+				if len(rhs) == 0:
+					if i == j and i in self.states:
+						productions.add((lhs, ()))
+					continue
+				# depth first search over the state sequences
+				stack = [(i, ())]
+				while stack:
+					(state, path) = stack.pop()
+					k = len(path)
+					symbol = rhs[k]
+					last = (k + 1 == len(rhs))
+					for nextstate in chart.ends[(state, symbol)]:
+						if last and nextstate != j:
+							continue
+						newpath = path + ((state, symbol, nextstate),)
+						if not last:
+							stack.append((nextstate, newpath))
+							continue
+						newrhs = []
+						for triple in newpath:
+							newrhs.append(self.getNonTerminal2(triple[0], triple[2], symbols[triple[1]], ntmap))
+							if not triple in done:
+								done.add(triple)
+								agenda.append(triple)
+						productions.add((lhs, tuple(newrhs)))
+		newgrammar.productions = productions
+		return newgrammar
+
 	def intersect_pcfg(self,grammar):
 		"""
 		return a new PCFG which is intersected with this regular language.
@@ -182,7 +290,7 @@ class FiniteAutomaton:
 				newproductions.append(prod)
 
 		# lexical rules
-		for arc in self.arcs:
+		for arc in self.expanded_arcs(grammar.terminals):
 			lhs = self.getNonTerminal(arc[0],arc[1],arc[2],ntmap)
 			production = pcfg.Production(lhs, [arc[2]])
 			production.probability = 1.0
@@ -219,6 +327,143 @@ class FiniteAutomaton:
 		newgrammar.constructIndices(False)
 		return newgrammar
 
+class _ProductChart:
+	"""
+	Bottom-up deduction over the Bar-Hillel product of an automaton and
+	a grammar, without building the product grammar.
+
+	A triple (i, s, j) means that symbol s derives a string that takes
+	the automaton from state i to state j. An item (p, d, h, e) means that
+	the first d symbols of the right hand side of production p take the
+	automaton from h to e. Symbols and productions are the ids of the
+	grammar index. The first derivation of each triple and item is kept
+	as a back pointer so that a witness string can be read off: None for
+	a terminal arc, () for an empty production and the completed item
+	otherwise.
+	"""
+
+	def __init__(self, fa, grammar, excluded_nt=None):
+		self.fa = fa
+		self.index = grammar.get_index()
+		index = self.index
+		self.excluded = None
+		if excluded_nt is not None and excluded_nt in index.symbol_ids:
+			self.excluded = (fa.initial, index.symbol_ids[excluded_nt], fa.final)
+		self.goals = set()
+		for s in index.start_ids:
+			for i in fa.start:
+				for j in fa.end:
+					self.goals.add((i, s, j))
+		self.goal = None
+		# triple -> back pointer, and (i, s) -> list of end states
+		self.triples = dict()
+		self.ends = collections.defaultdict(list)
+		# item -> back pointer, and (p, d, e) -> list of start states
+		self.items = dict()
+		self.waiting = collections.defaultdict(list)
+		self.agenda = []
+		for arc in fa.expanded_arcs(index.used_terminals()):
+			s = index.symbol_ids.get(arc[2])
+			if s is not None and index.is_terminal[s]:
+				self._add_triple((arc[0], s, arc[1]), None)
+		for p in index.prods_with_arity(0):
+			for i in fa.states:
+				self._add_triple((i, index.prod_lhs[p], i), ())
+
+	def _add_triple(self, triple, back):
+		if not triple in self.triples and triple != self.excluded:
+			self.triples[triple] = back
+			self.agenda.append(triple)
+			if self.goal is None and triple in self.goals:
+				self.goal = triple
+
+	def _add_item(self, item, back):
+		if not item in self.items:
+			self.items[item] = back
+			self.agenda.append(item)
+
+	def run(self, stop=False):
+		"""
+		Process the agenda. If stop is true, return as soon as a goal
+		triple has been derived. Returns the goal triple or None.
+		"""
+		index = self.index
+		agenda = self.agenda
+		while agenda:
+			if stop and self.goal is not None:
+				break
+			x = agenda.pop()
+			if len(x) == 3:
+				(i, s, j) = x
+				self.ends[(i, s)].append(j)
+				for p, k in index.occurrences_of(s):
+					if k == 0:
+						self._add_item((p, 1, i, j), (None, x))
+					else:
+						for h in self.waiting[(p, k, i)]:
+							self._add_item((p, k + 1, h, j), ((p, k, h, i), x))
+			else:
+				(p, d, h, e) = x
+				start = index.rhs_offsets[p]
+				if start + d == index.rhs_offsets[p + 1]:
+					self._add_triple((h, index.prod_lhs[p], e), x)
+				else:
+					self.waiting[(p, d, e)].append(h)
+					s = index.rhs_symbols[start + d]
+					for j in self.ends[(e, s)]:
+						self._add_item((p, d + 1, h, j), (x, (e, s, j)))
+		return self.goal
+
+	def witness(self, triple):
+		"""
+		Return the string of the first derivation of a triple, as a tuple.
+		"""
+		index = self.index
+		result = []
+		stack = [triple]
+		while stack:
+			x = stack.pop()
+			if len(x) == 3:
+				back = self.triples[x]
+				if back is None:
+					result.append(index.symbols[x[1]])
+				elif back:
+					stack.append(back)
+			else:
+				(previous, child) = self.items[x]
+				stack.append(child)
+				if previous is not None:
+					stack.append(previous)
+		return tuple(result)
+
+
+def intersection_witness(fa, grammar, excluded_nt=None):
+	"""
+	Return a string that is accepted by the automaton and generated by
+	the grammar, or None if there is none.
+	
+	If excluded_nt is given then derivations that use the nonterminal
+	(fa.initial, excluded_nt, fa.final) are not allowed, as in
+	intersect_cfg_remove.
+	This gives the same answer as intersecting, trimming and checking
+	for emptiness, but only derives the triples that are needed and stops
+	at the first derivation of a start symbol.
+	"""
+	chart = _ProductChart(fa, grammar, excluded_nt)
+	goal = chart.run(stop=True)
+	if goal is None:
+		return None
+	return chart.witness(goal)
+
+
+def intersection_is_empty(fa, grammar, excluded_nt=None):
+	"""
+	Return true if the intersection of the automaton and the grammar is
+	empty. See intersection_witness.
+	"""
+	return intersection_witness(fa, grammar, excluded_nt) is None
+
+
 #
 # Factory methods
 # to produce FAs that are useful for prefix, suffix etc,
@@ -232,13 +477,13 @@ def make_context(context, alphabet):
 	left = context[0]
 	right = context[1]
 	fa = FiniteAutomaton()
+	fa.alphabet = frozenset(alphabet)
 	current = 0
 	fa.start.add(current)
 	for s in left:
 		fa.addArc(current, current+1,s)
 		current += 1
-	for s in alphabet:
-		fa.addArc(current,current,s)
+	fa.addAnyArc(current,current)
 	for s in right:
 		fa.addArc(current, current+1,s)
 		current += 1
@@ -255,6 +500,7 @@ def make_context_long(context, alphabet):
 	left = context[0]
 	right = context[1]
 	fa = FiniteAutomaton()
+	fa.alphabet = frozenset(alphabet)
 	current = 0
 	fa.start.add(current)
 	for s in left:
@@ -269,29 +515,29 @@ def make_context_long(context, alphabet):
 		current += 1
 	fa.end.add(current)
 
-	for s in alphabet:
-		fa.addArc(fa.initial,middle,s)
-		fa.addArc(middle,middle,s)
-		fa.addArc(middle,fa.final,s)
-		fa.addArc(fa.initial,fa.final,s)
+	fa.addAnyArc(fa.initial,middle)
+	fa.addAnyArc(middle,middle)
+	fa.addAnyArc(middle,fa.final)
+	fa.addAnyArc(fa.initial,fa.final)
 
 	return fa
 
 
-def make_infix(stringlist,alphabet):
+def make_infix(stringlist,alphabet,excluded=()):
 	"""
-	Construct an automaton that recognizes \Sigma^* w \Sigma^*
+	Construct an automaton that recognizes \Sigma^* w \Sigma^*,
+	where \Sigma is the alphabet without the excluded symbols.
 	"""
 	fa = FiniteAutomaton()
+	fa.alphabet = frozenset(alphabet)
 	current = 0
 	fa.start.add(current)
 	for s in stringlist:
 		fa.addArc(current,current+1,s)
 		current += 1
 	fa.end.add(current)
-	for s in alphabet:
-		fa.addArc(0,0,s)
-		fa.addArc(current,current,s)
+	fa.addAnyArc(0,0,excluded)
+	fa.addAnyArc(current,current,excluded)
 	return fa
 
 def make_infix_long(stringlist,alphabet):
@@ -302,7 +548,7 @@ def make_infix_long(stringlist,alphabet):
 	self.initial and self.final.
 	"""
 	fa = FiniteAutomaton()
-	
+	fa.alphabet = frozenset(alphabet)
 
 	current = 0
 	fa.start.add(0)
@@ -314,11 +560,10 @@ def make_infix_long(stringlist,alphabet):
 	final = current+1
 	fa.end.add(current)
 	fa.end.add(final)
-	for s in alphabet:
-		fa.addArc(0,1,s)
-		fa.addArc(0,0,s)
-		fa.addArc(current,final,s)
-		fa.addArc(final,final,s)
+	fa.addAnyArc(0,1)
+	fa.addAnyArc(0,0)
+	fa.addAnyArc(current,final)
+	fa.addAnyArc(final,final)
 	fa.initial = 1
 	fa.final = current
 	return fa
@@ -331,14 +576,14 @@ def make_prefix(stringlist, alphabet):
 	Construct an automaton that recognizes w \Sigma^*
 	"""
 	fa = FiniteAutomaton()
+	fa.alphabet = frozenset(alphabet)
 	current = 0
 	fa.start.add(current)
 	for s in stringlist:
 		fa.addArc(current,current+1,s)
 		current += 1
 	fa.end.add(current)
-	for s in alphabet:
-		fa.addArc(current,current,s)
+	fa.addAnyArc(current,current)
 	return fa
 
 
@@ -1,6 +1,13 @@
 # Based on Elizabeth Scott 2008 paper
+import array
+import itertools
 import logging
+import random
 import earleyparser
+import tree
+
+# Node level tracing through the logging module; see earleyparser.trace_parser.
+trace_forest = False
 
 class ForestBuilder:
 	"""
@@ -42,14 +49,14 @@ class ForestBuilder:
 	def build_tree(self, u, item):
 		self.completed.add(item)
 		parser = self.parser
-		logging.info("Build tree item %s node %s" % (earleyparser.to_string(item), u.get_index()))
+		if trace_forest:
+			logging.info("Build tree item %s node %s", earleyparser.to_string(item), u.get_index())
 		(lhs,rhs,position, start,end) = item
 		assert u.start == start
 		assert u.end == end
 		if len(rhs) == 0:
 			# epsilon production
-			v = self.get_node(start,end,lhs)
-			u.add_unary(v)
+			u.add_empty()
 			return
 		if position == 0:
 			return
@@ -118,31 +125,11 @@ class ForestNode:
 		"""
 		Returns -1 if infinite.
 		"""
-		counts = {}
-		visited = set()
 		try:
-			return self.count_trees2(counts, visited)
+			return tree_counts([self])[self]
 		except ValueError:
 			return -1
 
-	def count_trees2(self, counts, visited):
-		logging.info("Counting : %s ", self.get_index())
-		if not self in counts:
-			if self in visited:
-				logging.info("Loop with %s", self.get_index())
-				raise ValueError("infinite")
-			visited.add(self)
-			if len(self.subtrees) == 0:
-				counts[self] = 1.0
-			else:
-				total = 0
-				for subtree in self.subtrees:
-					logging.info( "subtree length %d" % len(subtree))
-					total += reduce(lambda x, y: x*y, [ x.count_trees2(counts, visited) for x in subtree ], 1.0)
-				counts[self] = total
-		logging.info("Leaving : %s, %s " % (self.get_index(), counts[self]))
-		return counts[self]
-
 	def count_trees_finite(self):
 		"""
 		Will not terminate if there are an infinite number of trees.
@@ -155,11 +142,27 @@ class ForestNode:
 		return total
 
 	def gather_trees(self):
-		if len(self.subtrees) == 0:
-			return [ label ]
-		for (x,y) in self.subtrees:
-			xtrees = x.gather_trees()
-			ytrees = y.gather_trees()
+		"""
+		List of all the trees below this node as tree.TreeNodes.
+		"""
+		return list(enumerate_trees([self]))
+
+	def sample_trees(self, k, weights=None):
+		"""
+		k trees below this node; see sample_trees.
+		"""
+		return sample_trees([self], k, weights)
+
+	def production(self, subtree):
+		"""
+		The production used by subtree, one of the subtrees of this node,
+		or None if this node is part of a longer production.
+		"""
+		if isinstance(self.label, tuple):
+			return None
+		if len(subtree) == 2:
+			return (self.label, subtree[0].label[1])
+		return (self.label, tuple(x.label for x in subtree))
 
 
 	def get_index(self):
@@ -174,6 +177,14 @@ class ForestNode:
 			self.subtrees.append((first,second))
 			self.subtree_set.add(index)	
 
+	def add_empty(self):
+		"""
+		An empty production.
+		"""
+		if not () in self.subtree_set:
+			self.subtrees.append(())
+			self.subtree_set.add(())
+
 	def add_unary(self, first):
 		"""
 		arguments is one ForestNode
@@ -181,3 +192,356 @@ class ForestNode:
 		if not first.get_index() in self.subtree_set:
 			self.subtrees.append((first,))
 			self.subtree_set.add(first.get_index())	
+
+
+
+def postorder(roots):
+	"""
+	Return the nodes below roots, daughters before mothers.
+	Raises ValueError if there is a loop.
+	"""
+	# absent unseen, 1 on the current path, 2 done
+	state = {}
+	result = []
+	stack = list(roots)
+	while stack:
+		x = stack[-1]
+		if state.get(x) == 2:
+			stack.pop()
+		elif state.get(x) == 1:
+			state[x] = 2
+			result.append(x)
+			stack.pop()
+		else:
+			state[x] = 1
+			for subtree in x.subtrees:
+				for y in subtree:
+					if state.get(y) == 1:
+						if trace_forest:
+							logging.info("Loop with %s", y.get_index())
+						raise ValueError("infinite")
+					if not y in state:
+						stack.append(y)
+	return result
+
+def _weight(node, subtree, counts, weights):
+	product = 1
+	for x in subtree:
+		product *= counts[x]
+	if weights is not None:
+		prod = node.production(subtree)
+		if prod is not None:
+			product *= weights.get(prod, 0)
+	return product
+
+def tree_counts(roots, weights=None):
+	"""
+	Map from the nodes below roots to their numbers of trees, as exact ints.
+	With weights, a map from productions to numbers, the inside weights:
+	the total over the trees of the product of their productions' weights.
+	Raises ValueError if there are infinitely many trees.
+	"""
+	counts = {}
+	for node in postorder(roots):
+		if not node.subtrees:
+			counts[node] = 1
+		else:
+			counts[node] = sum(_weight(node, subtree, counts, weights) for subtree in node.subtrees)
+	return counts
+
+def _build_tree(root, counts, rank, weights=None):
+	"""
+	The tree.TreeNode of the tree below root with this rank, in the order
+	of the subtrees and counts; if rank is None, a random tree with
+	probability proportional to its weight.
+	"""
+	result = None
+	stack = [ (root, None, rank) ]
+	while stack:
+		node, mother, rank = stack.pop()
+		if isinstance(node.label, tuple):
+			# part of a longer production: the daughters go to the mother
+			current = mother
+		else:
+			current = tree.TreeNode(node.label)
+			if mother is None:
+				result = current
+			else:
+				mother.daughters.append(current)
+		if not node.subtrees:
+			continue
+		if rank is None:
+			r = random.random() * counts[node]
+		else:
+			r = rank
+		for subtree in node.subtrees:
+			w = _weight(node, subtree, counts, weights)
+			if r < w:
+				break
+			r -= w
+		# daughters are pushed right to left so they are popped left to right
+		for x in reversed(subtree):
+			if rank is None:
+				stack.append((x, current, None))
+			else:
+				r, daughter_rank = divmod(r, counts[x])
+				stack.append((x, current, daughter_rank))
+	return result
+
+def unrank_tree(roots, rank, counts=None):
+	"""
+	The tree below roots with this rank, from 0 to the number of trees.
+	"""
+	if counts is None:
+		counts = tree_counts(roots)
+	for root in roots:
+		if rank < counts[root]:
+			return _build_tree(root, counts, rank)
+		rank -= counts[root]
+	raise ValueError("rank %d out of range" % rank)
+
+def enumerate_trees(roots):
+	"""
+	Generate the trees below roots lazily in order of rank, so the top n
+	are itertools.islice(enumerate_trees(roots), n).
+	Raises ValueError if there are infinitely many.
+	"""
+	counts = tree_counts(roots)
+	for rank in xrange(sum(counts[root] for root in roots)):
+		yield unrank_tree(roots, rank, counts)
+
+def sample_trees(roots, k, weights=None):
+	"""
+	Draw k trees below roots, with replacement, uniformly at random, or
+	with probability proportional to the product of the weights of
+	their productions, given as a map from productions to numbers.
+	The per-node counts are computed once for all k.
+	Raises ValueError if there are infinitely many trees.
+	"""
+	counts = tree_counts(roots, weights)
+	totals = [ counts[root] for root in roots ]
+	total = sum(totals)
+	if not total:
+		raise ValueError("no trees")
+	result = []
+	for i in xrange(k):
+		if weights is None:
+			r = random.randrange(total)
+		else:
+			r = random.random() * total
+		for root, n in zip(roots, totals):
+			if r < n:
+				break
+			r -= n
+		if weights is None:
+			result.append(_build_tree(root, counts, r))
+		else:
+			result.append(_build_tree(root, counts, None, weights))
+	return result
+
+
+class CompactForest:
+	"""
+	The same shared packed forest as ForestBuilder, stored compactly.
+
+	Nodes are ids; index maps (start, end, label) to the id, and the
+	spans and labels are kept in flat arrays. The packed alternatives of
+	node x are left[k], right[k] for offsets[x] <= k < offsets[x+1], where
+	-1 marks a missing daughter, so (-1, -1) is an empty production.
+	A node without alternatives is a leaf.
+
+	Building, counting and traversal use explicit stacks instead of
+	recursion, so long inputs do not run into the recursion limit.
+	"""
+
+	def __init__(self, word, cfg, parser):
+		self.word = word
+		self.cfg = cfg
+		self.parser = parser
+		# map from (start, end, label) to node ids
+		self.index = {}
+		self.starts = array.array('i')
+		self.ends = array.array('i')
+		self.labels = []
+		self.roots = []
+		# alternatives while building: owner, left, right.
+		self._alternatives = (array.array('i'), array.array('i'), array.array('i'))
+		self._seen = set()
+		self.offsets = None
+		self.left = None
+		self.right = None
+
+	def __len__(self):
+		return len(self.labels)
+
+	def get_node(self, start, end, label):
+		"""
+		Return the id of the node with this span and label, creating it
+		if needed.
+		"""
+		cspan = (start,end,label)
+		node = self.index.get(cspan)
+		if node is None:
+			node = len(self.labels)
+			self.index[cspan] = node
+			self.starts.append(start)
+			self.ends.append(end)
+			self.labels.append(label)
+		return node
+
+	def get_index(self, node):
+		return (self.starts[node], self.ends[node], self.labels[node])
+
+	def _add(self, node, first, second):
+		key = (node, first, second)
+		if not key in self._seen:
+			self._seen.add(key)
+			for values, x in zip(self._alternatives, key):
+				values.append(x)
+
+	def _item_node(self, item):
+		(lhs,rhs,position, start,end) = item
+		if position == len(rhs):
+			return self.get_node(start, end, lhs)
+		return self.get_node(start, end, (lhs, rhs, position))
+
+	def build(self, items):
+		"""
+		Build the forest below the complete items in items, which become
+		the roots, and pack it.  Follows ForestBuilder.build_tree, except
+		that an empty production is an empty alternative rather than a
+		loop on the node.
+		"""
+		parser = self.parser
+		terminals = self.cfg.terminals
+		completed = set()
+		stack = []
+		for item in items:
+			self.roots.append(self._item_node(item))
+			if not item in completed:
+				completed.add(item)
+				stack.append(item)
+		def push(x):
+			if not x in completed:
+				completed.add(x)
+				stack.append(x)
+		while stack:
+			item = stack.pop()
+			u = self._item_node(item)
+			if trace_forest:
+				logging.info("Build tree item %s node %s", earleyparser.to_string(item), self.get_index(u))
+			(lhs,rhs,position, start,end) = item
+			if len(rhs) == 0:
+				self._add(u, -1, -1)
+			elif position == 0:
+				continue
+			elif position == 1:
+				v = self.get_node(start,end,rhs[0])
+				self._add(u, v, -1)
+				if not rhs[0] in terminals:
+					for complete_item in parser.reduced_states[item]:
+						push(complete_item)
+			elif rhs[position - 1] in terminals:
+				v = self.get_node(end-1,end,rhs[position -1 ])
+				w = self.get_node(start,end-1, (lhs,rhs,position-1))
+				for incomplete in parser.previous_states[item]:
+					push(incomplete)
+				self._add(u, w, v)
+			else:
+				for complete_item in parser.reduced_states[item]:
+					cstart = complete_item[3]
+					v = self.get_node(cstart,end,complete_item[0])
+					push(complete_item)
+					w = self.get_node(start,cstart,  (lhs,rhs, position -1))
+					for incomplete_item in parser.previous_states[item]:
+						if incomplete_item[4] == cstart:
+							push(incomplete_item)
+					self._add(u, w, v)
+		self._pack()
+
+	def _pack(self):
+		"""
+		Group the alternatives by node into the offsets, left and right arrays.
+		"""
+		owners, lefts, rights = self._alternatives
+		n = len(self.labels)
+		counts = [0] * (n + 1)
+		for x in owners:
+			counts[x + 1] += 1
+		for x in xrange(n):
+			counts[x + 1] += counts[x]
+		self.offsets = array.array('i', counts)
+		self.left = array.array('i', [-1]) * len(owners)
+		self.right = array.array('i', [-1]) * len(owners)
+		fill = list(counts)
+		for owner, first, second in itertools.izip(owners, lefts, rights):
+			k = fill[owner]
+			fill[owner] = k + 1
+			self.left[k] = first
+			self.right[k] = second
+		self._alternatives = None
+		self._seen = None
+
+	def alternatives(self, node):
+		"""
+		The packed alternatives of node as tuples of daughter ids.
+		"""
+		result = []
+		for k in xrange(self.offsets[node], self.offsets[node + 1]):
+			result.append(tuple(x for x in (self.left[k], self.right[k]) if x >= 0))
+		return result
+
+	def postorder(self, node):
+		"""
+		Return the nodes below node, daughters before mothers.
+		Raises ValueError if there is a loop.
+		"""
+		offsets, left, right = self.offsets, self.left, self.right
+		# 0 unseen, 1 on the current path, 2 done
+		state = bytearray(len(self.labels))
+		result = []
+		stack = [node]
+		while stack:
+			x = stack[-1]
+			if state[x] == 2:
+				stack.pop()
+			elif state[x] == 1:
+				state[x] = 2
+				result.append(x)
+				stack.pop()
+			else:
+				state[x] = 1
+				for k in xrange(offsets[x], offsets[x + 1]):
+					for y in (left[k], right[k]):
+						if y >= 0:
+							if state[y] == 1:
+								if trace_forest:
+									logging.info("Loop with %s", self.get_index(y))
+								raise ValueError("infinite")
+							if state[y] == 0:
+								stack.append(y)
+		return result
+
+	def count_trees(self, node):
+		"""
+		Number of trees below node as an exact int; -1 if infinite.
+		"""
+		try:
+			order = self.postorder(node)
+		except ValueError:
+			return -1
+		offsets, left, right = self.offsets, self.left, self.right
+		counts = dict()
+		for x in order:
+			if offsets[x] == offsets[x + 1]:
+				counts[x] = 1
+				continue
+			total = 0
+			for k in xrange(offsets[x], offsets[x + 1]):
+				product = 1
+				for y in (left[k], right[k]):
+					if y >= 0:
+						product *= counts[y]
+				total += product
+			counts[x] = total
+		return counts[node]
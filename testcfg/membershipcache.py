@@ -0,0 +1,71 @@
+import collections
+
+
+class MembershipCache:
+	"""
+	A bounded LRU cache for the answers of membership queries.
+
+	Keys are tuples that start with a grammar fingerprint and the kind of
+	query (parse, parse_start or parse_nonterminal_context), followed by
+	the input, so one cache can be shared between parsers and grammars.
+	"""
+
+	def __init__(self, size=100000):
+		self.size = size
+		self.table = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, compute):
+		"""
+		Return the cached answer for key, or call compute() and cache
+		its result.
+		"""
+		table = self.table
+		if key in table:
+			self.hits += 1
+			# move to the most recently used end
+			answer = table.pop(key)
+			table[key] = answer
+			return answer
+		self.misses += 1
+		answer = compute()
+		self.put(key, answer)
+		return answer
+
+	def lookup(self, key, default=None):
+		"""
+		Return the cached answer for key, or default.
+		Counts as a hit or a miss.
+		"""
+		if key in self.table:
+			self.hits += 1
+			answer = self.table.pop(key)
+			self.table[key] = answer
+			return answer
+		self.misses += 1
+		return default
+
+	def put(self, key, answer):
+		self.table[key] = answer
+		if len(self.table) > self.size:
+			self.table.popitem(last=False)
+
+	def hit_rate(self):
+		total = self.hits + self.misses
+		if total == 0:
+			return 0.0
+		return float(self.hits) / total
+
+	def stats(self):
+		"""
+		Return a dict with the hit and miss counts, the hit rate and the
+		number of entries.
+		"""
+		return { "hits" : self.hits, "misses" : self.misses,
+			"hit_rate" : self.hit_rate(), "entries" : len(self.table) }
+
+	def clear(self):
+		self.table.clear()
+		self.hits = 0
+		self.misses = 0
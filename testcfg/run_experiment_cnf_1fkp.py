@@ -49,42 +49,34 @@ for lprod in xrange(25, 301, 25):
     fkpn = 0.0
     fkpn_no_lex = 0.0
     for i in xrange(number_grammars):
-        no_error = False
-        while not no_error:
-            no_error = True
-            grammar = factory.make_grammar(trim=False)
-
-            # Display information about the experiment.
-            trial_heading = "Grammar " + str(i + 1) + ": "
-            if grammar.language_infinite():
-                trial_heading += "Infinite"
-            else:
-                trial_heading += "Finite"
-            trial_heading += " with " + str(len(grammar.nonterminals)) + " nonterminals"
-            print trial_heading
-
-            # Test if the grammar has the 1-FKP.
-            # Make two copies of the grammar: one with and one without lexical rules.
-            grammar_no_lex = deepcopy(grammar)
-            try:
-                grammar.trim()
-                answer = cfgfcp.test_one_fkp_exact(grammar, 10)
-
-                grammar_no_lex.remove_lexical_rules()
-                grammar_no_lex.trim()
-                answer_no_lex = cfgfcp.test_one_fkp_exact(grammar_no_lex, 10)
-            except:
-                print "An error occurred. Trying again."
-                no_error = False
-                continue
-
-            # Report and record the results.
-            print "1-kernels: " + str(answer)
-            print "1-kernels (no lex): " + str(answer_no_lex)
-            if answer:
-                fkpn += 1
-            if answer_no_lex:
-                fkpn_no_lex += 1
+        grammar = factory.make_grammar(trim=False)
+
+        # Display information about the experiment.
+        trial_heading = "Grammar " + str(i + 1) + ": "
+        if grammar.language_infinite():
+            trial_heading += "Infinite"
+        else:
+            trial_heading += "Finite"
+        trial_heading += " with " + str(len(grammar.nonterminals)) + " nonterminals"
+        print trial_heading
+
+        # Test if the grammar has the 1-FKP.
+        # Make two copies of the grammar: one with and one without lexical rules.
+        grammar_no_lex = deepcopy(grammar)
+        grammar = grammar.trim()
+        answer = cfgfcp.test_one_fkp_exact(grammar, 10)
+
+        grammar_no_lex.remove_lexical_rules()
+        grammar_no_lex = grammar_no_lex.trim()
+        answer_no_lex = cfgfcp.test_one_fkp_exact(grammar_no_lex, 10)
+
+        # Report and record the results.
+        print "1-kernels: " + str(answer)
+        print "1-kernels (no lex): " + str(answer_no_lex)
+        if answer:
+            fkpn += 1
+        if answer_no_lex:
+            fkpn_no_lex += 1
 
     # Report and record the final results.
     ratio = fkpn / number_grammars
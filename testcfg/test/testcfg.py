@@ -5,11 +5,19 @@ import cfg
 import cfgfcp
 import generatecfg
 import earleyparser
+import finiteautomaton
+import forest
+import tree
+import ckyparser
+import countingparser
+import membershipcache
 import partitionfunction
 import inside
 import math
+import collections
 import logging
 import sys, random
+import os, shutil, tempfile
 import uniformsampler, generatepcfg
 #testcode for pcfgs
 
@@ -173,6 +181,136 @@ class CfgTest(unittest.TestCase):
 		self.assertEqual(1, len(x))
 		self.assertEqual(x[0].count_trees(),9694845.0 )
 
+	def test_counting_parser(self):
+		grammar = cfg.load_from_file("../data/cfgs/sigmaplus2.cfg")
+		parser = countingparser.CountingParser(grammar)
+		w = ("a", "b", "a", "a", "b", "a", "a", "a", "a", "b", "a", "a", "b", "a", "a", "a")
+		self.assertEqual(parser.count_parses(w), 9694845)
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		parser = countingparser.CountingParser(grammar)
+		sampler = uniformsampler.UniformSampler(grammar, 6, mode="exact")
+		for l in xrange(6):
+			counts = collections.Counter(sampler.unrank_yield(None, l, i) for i in xrange(sampler.get_total(l)))
+			for w, n in counts.iteritems():
+				self.assertEqual(parser.count_parses(w), n)
+
+	def test_count_parses_nullable(self):
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S","N1","N2"])
+		grammar.terminals = set(["a"])
+		grammar.start_set = set(["S"])
+		for prod in [("N1",()), ("N1",("a","N2","N1")), ("N2",("N1",)), ("S",("N1","N2"))]:
+			grammar.productions.add(prod)
+		parser = earleyparser.EarleyParser(grammar)
+		counter = countingparser.CountingParser(grammar)
+		self.assertEqual(parser.count_parses(("a","a")), 5)
+		for l in xrange(5):
+			w = ("a",) * l
+			self.assertEqual(parser.count_parses(w), counter.count_parses(w))
+
+	def test_compact_forest(self):
+		grammar = cfg.load_from_file("../data/cfgs/sigmaplus2.cfg")
+		parser = earleyparser.EarleyParser(grammar)
+		w = ("a", "b", "a", "a", "b", "a", "a", "a", "a", "b", "a", "a", "b", "a", "a", "a")
+		compact = parser.parse_compact_forest(w)
+		self.assertEqual(len(compact.roots), 1)
+		self.assertEqual(compact.count_trees(compact.roots[0]), 9694845)
+		self.assertEqual(parser.count_parses(w), 9694845)
+		w = w[:8]
+		compact = parser.parse_compact_forest(w)
+		order = compact.postorder(compact.roots[0])
+		self.assertEqual(order[-1], compact.roots[0])
+		self.assertEqual(compact.get_index(order[-1])[:2], (0, 8))
+		roots = parser.parse_forest(w)
+		self.assertEqual(len(roots), 1)
+		self.assertEqual(compact.count_trees(compact.roots[0]), roots[0].count_trees())
+
+	def test_sample_trees(self):
+		grammar = cfg.load_from_file("../data/cfgs/sigmaplus2.cfg")
+		parser = earleyparser.EarleyParser(grammar)
+		w = ("a", "b", "a", "a", "b", "a")
+		roots = parser.parse_forest(w)
+		trees = list(forest.enumerate_trees(roots))
+		self.assertEqual(len(trees), parser.count_parses(w))
+		self.assertEqual(forest.unrank_tree(roots, 1).collectYield(), trees[1].collectYield())
+		for x in trees + forest.sample_trees(roots, 10):
+			self.assertEqual(tuple(x.collectYield()), w)
+		self.assertEqual(len(roots[0].sample_trees(3)), 3)
+
+	def test_sample_trees_nullable(self):
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S","N1","N2","N3"])
+		grammar.terminals = set(["a"])
+		grammar.start_set = set(["S"])
+		for prod in [("N1",()), ("N1",("N2","N3","a")), ("N2",("N1","N1")), ("N3",()), ("S",("N3","N2","N3"))]:
+			grammar.productions.add(prod)
+		parser = earleyparser.EarleyParser(grammar)
+		w = ("a",)
+		roots = parser.parse_forest(w)
+		trees = list(forest.enumerate_trees(roots))
+		self.assertEqual(len(trees), parser.count_parses(w))
+		for x in trees + forest.sample_trees(roots, 10):
+			self.assertEqual(tuple(x.collectYield()), w)
+			counter = collections.Counter()
+			x.count_productions(counter)
+			for prod in counter:
+				self.assertTrue(prod in grammar.productions)
+
+	def test_flat_tree(self):
+		root = tree.TreeNode("S")
+		a = tree.TreeNode("A")
+		a.daughters.append(tree.TreeNode("a"))
+		root.daughters = [a, tree.TreeNode("b"), tree.TreeNode("c")]
+		flat = root.flatten()
+		self.assertEqual(list(flat.size), [5, 2, 1, 1, 1])
+		self.assertEqual(flat.depth(), root.depth())
+		self.assertEqual(flat.width(), 3)
+		self.assertEqual(flat.collectYield(), ["a", "b", "c"])
+		self.assertEqual(flat.collect_contexts_of_nt("A"), root.collect_contexts_of_nt("A"))
+		self.assertEqual(flat.to_tree().collectYield(), root.collectYield())
+		# deeper than the recursion limit
+		for i in xrange(sys.getrecursionlimit() + 10):
+			node = tree.TreeNode("S")
+			node.daughters = [tree.TreeNode("a"), root]
+			root = node
+		self.assertEqual(root.depth(), sys.getrecursionlimit() + 12)
+		self.assertEqual(root.flatten().depth(), root.depth())
+		self.assertEqual(root.collect_contexts_of_nt("A")[0][1], ("b", "c"))
+
+	def test_flat_tree_shared_index(self):
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S"])
+		grammar.terminals = set(["a"])
+		grammar.start_set = set(["S"])
+		grammar.productions.add(("S",("a",)))
+		index = grammar.get_index()
+		symbols = list(index.symbols)
+		root = tree.TreeNode("S")
+		root.daughters = [tree.TreeNode("a")]
+		flat = root.flatten(index.symbols, index.symbol_ids)
+		self.assertTrue(flat.symbols is index.symbols)
+		# a label that is not in the grammar
+		root.daughters.append(tree.TreeNode("b"))
+		flat = root.flatten(index.symbols, index.symbol_ids)
+		self.assertEqual(flat.collectYield(), ["a", "b"])
+		self.assertEqual(index.symbols, symbols)
+		self.assertFalse("b" in index.symbol_ids)
+		self.assertTrue(index is grammar.get_index())
+		self.assertEqual(set(index.used_terminals()), set(["a"]))
+
+	def test_collect_all_contexts(self):
+		root = tree.TreeNode("S")
+		a = tree.TreeNode("A")
+		a.daughters.append(tree.TreeNode("a"))
+		b = tree.TreeNode("A")
+		b.daughters = [tree.TreeNode("b"), a]
+		root.daughters = [b, tree.TreeNode("c")]
+		contexts = root.collect_all_contexts()
+		self.assertEqual(contexts["S"], [((), ())])
+		self.assertEqual(contexts["A"], [((), ("c",)), (("b",), ("c",))])
+		self.assertEqual(root.collect_contexts_of_nt("A"), contexts["A"])
+		self.assertEqual(root.flatten().collect_all_contexts(), contexts)
+
 	def test_merge(self):
 		grammar = cfg.load_from_file("../data/cfgs/unary_loops1.cfg")
 		self.assertTrue(grammar.has_unary_loops())
@@ -232,6 +370,191 @@ class CfgTest(unittest.TestCase):
 		self.assertEqual(sampler.get("S",3),0)
 		self.assertEqual(sampler.get("S",5),0)
 
+	def test_uniformsampler_nullable(self):
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S","A"])
+		grammar.terminals = set(["a"])
+		grammar.start_set = set(["S"])
+		for prod in [("S",("A","S")), ("S",()), ("A",("a",)), ("A",("a","a"))]:
+			grammar.productions.add(prod)
+		sampler = uniformsampler.UniformSampler(grammar, 10)
+		# compositions of the length into ones and twos.
+		fibonacci = [1, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89]
+		for i in xrange(11):
+			self.assertEqual(sampler.get("S",i), fibonacci[i])
+		self.assertEqual(sampler.get_total(10), 89)
+		# S is nullable only through D, and comes after D in the topological order
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S","D"])
+		grammar.terminals = set(["a"])
+		grammar.start_set = set(["S"])
+		for prod in [("S",("D",)), ("D",()), ("D",("a",)), ("D",("a","D","S"))]:
+			grammar.productions.add(prod)
+		sampler = uniformsampler.UniformSampler(grammar, 5)
+		for i, n in enumerate([1, 2, 4, 12, 40, 144]):
+			self.assertEqual(sampler.get("S",i), n)
+
+	def test_shortest_yield(self):
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S","A"])
+		grammar.terminals = set(["a"])
+		grammar.start_set = set(["S"])
+		for prod in [("S",("A","S")), ("S",()), ("A",("a",)), ("A",("a","a"))]:
+			grammar.productions.add(prod)
+		sampler = uniformsampler.UniformSampler(grammar, 10)
+		self.assertEqual(tuple(sampler.get_a_shortest_yield("S")), ())
+		self.assertEqual(tuple(sampler.get_a_shortest_yield("A")), ("a",))
+
+	def test_uniformsampler_modes(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg1.cfg")
+		sampler = uniformsampler.UniformSampler(grammar, 20)
+		exact = uniformsampler.UniformSampler(grammar, 20, mode="exact")
+		logs = uniformsampler.UniformSampler(grammar, 20, mode="log")
+		for i in xrange(21):
+			self.assertEqual(exact.get("S",i), sampler.get("S",i))
+			self.assertAlmostEqual(logs.get("S",i), sampler.get("S",i))
+		self.assertTrue(isinstance(exact.get_total(5), (int, long)))
+		self.assertEqual(exact.sample(5).width(), 5)
+		self.assertEqual(logs.sample(5).width(), 5)
+		contextsampler = uniformsampler.ContextSampler(grammar, exact, 10)
+		self.assertEqual(contextsampler.mode, "exact")
+
+	def test_uniformsampler_cumulative(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg1.cfg")
+		sampler = uniformsampler.UniformSampler(grammar, 10, mode="exact")
+		for i in xrange(20):
+			self.assertEqual(sampler.sample(5).width(), 5)
+		items, cumulative = sampler.cumulative[("S", 5)]
+		self.assertEqual(cumulative[-1], sampler.get("S", 5))
+		self.assertEqual(len(items), len(cumulative))
+
+	def test_sample_yield(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg1.cfg")
+		sampler = uniformsampler.UniformSampler(grammar, 10)
+		parser = earleyparser.EarleyParser(grammar)
+		for i in xrange(20):
+			w = sampler.sample_yield(5)
+			self.assertEqual(len(w), 5)
+			self.assertTrue(parser.parse(w))
+		random.seed(3)
+		w = tuple(sampler.sample_from_nonterminal("S", 7).collectYield())
+		random.seed(3)
+		self.assertEqual(sampler.sample_yield_from("S", 7), w)
+
+	def test_sample_batch(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		sampler = uniformsampler.UniformSampler(grammar, 10)
+		contextsampler = uniformsampler.ContextSampler(grammar, sampler, 10)
+		parser = earleyparser.EarleyParser(grammar)
+		strings = sampler.sample_batch(6, 50)
+		self.assertEqual(len(strings), 50)
+		for w in strings:
+			self.assertEqual(len(w), 6)
+			self.assertTrue(parser.parse(w))
+		for nt in grammar.nonterminals:
+			if contextsampler.get(nt, 4) > 0:
+				for left, right in contextsampler.sample_context_batch(nt, 4, 20):
+					self.assertEqual(len(left) + len(right), 4)
+					self.assertTrue(parser.parse_nonterminal_context(left, nt, right))
+
+	def test_multiple_sample_short(self):
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S"])
+		grammar.terminals = set(["a", "b"])
+		grammar.start_set = set(["S"])
+		for prod in [("S",("a",)), ("S",("b",))]:
+			grammar.productions.add(prod)
+		sampler = uniformsampler.UniformSampler(grammar, 4, mode="exact")
+		# only two strings, so most of the samples are repeats
+		samples = sampler.multiple_sample(10, 2)
+		self.assertEqual(len(samples), 10)
+		self.assertEqual(set(tuple(w) for w in samples), set([("a",), ("b",)]))
+
+	def test_extend_to(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		full = uniformsampler.UniformSampler(grammar, 12, mode="exact")
+		grown = uniformsampler.UniformSampler(grammar, 4, mode="exact")
+		contexts = uniformsampler.ContextSampler(grammar, grown, 4)
+		contexts.extend_to(12)
+		self.assertEqual(grown.max_length, 12)
+		fullcontexts = uniformsampler.ContextSampler(grammar, full, 12)
+		for i in xrange(13):
+			self.assertEqual(full.get_total(i), grown.get_total(i))
+			for nt in grammar.nonterminals:
+				self.assertEqual(full.get(nt, i), grown.get(nt, i))
+				self.assertEqual(fullcontexts.get(nt, i), contexts.get(nt, i))
+
+	def test_context_counts(self):
+		factory = generatecfg.CnfFactory()
+		factory.number_nonterminals = 10
+		factory.number_terminals = 10
+		factory.number_binary_productions = 30
+		factory.number_lexical_productions = 30
+		grammar = factory.make_grammar()
+		sampler = uniformsampler.UniformSampler(grammar, 12, mode="exact")
+		contextsampler = uniformsampler.ContextSampler(grammar, sampler, 12)
+		# every position of every tree of length l is under one lexical rule
+		for l in xrange(1, 13):
+			positions = sum(contextsampler.get(nt, l - 1) * sampler.get(nt, 1) for nt in grammar.nonterminals)
+			self.assertEqual(positions, l * sampler.get_total(l))
+
+	def test_sampler_cache(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		cache_dir = tempfile.mkdtemp()
+		try:
+			for mode in uniformsampler.modes:
+				fresh = uniformsampler.UniformSampler(grammar, 10, mode=mode)
+				freshcontexts = uniformsampler.ContextSampler(grammar, fresh, 10)
+				for i in xrange(2):
+					sampler = uniformsampler.UniformSampler(grammar, 10, mode=mode, cache_dir=cache_dir)
+					contexts = uniformsampler.ContextSampler(grammar, sampler, 10, cache_dir=cache_dir)
+					for l in xrange(11):
+						self.assertEqual(fresh.get_total(l), sampler.get_total(l))
+						for nt in grammar.nonterminals:
+							self.assertEqual(freshcontexts.get(nt, l), contexts.get(nt, l))
+					if mode == "exact":
+						self.assertTrue(isinstance(sampler.get_total(10), (int, long)))
+			self.assertEqual(len(os.listdir(cache_dir)), 6)
+			# stored without pickles
+			for name in os.listdir(cache_dir):
+				uniformsampler.np.load(os.path.join(cache_dir, name), allow_pickle=False)
+		finally:
+			shutil.rmtree(cache_dir)
+
+	def test_generate_all(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		sampler = uniformsampler.UniformSampler(grammar, 6, mode="exact")
+		contextsampler = uniformsampler.ContextSampler(grammar, sampler, 6)
+		parser = earleyparser.EarleyParser(grammar)
+		for l in xrange(6):
+			trees = list(sampler.generateAll(l))
+			self.assertEqual(len(trees), sampler.get_total(l))
+			yields = list(sampler.enumerate_yields(l))
+			self.assertEqual(set(yields), set(tuple(t.collectYield()) for t in trees))
+			self.assertEqual(len(yields), len(set(yields)))
+			self.assertEqual(list(sampler.enumerate_yields(l, limit=2)), yields[:2])
+			for nt in grammar.nonterminals:
+				for left, right in contextsampler.enumerate_contexts(nt, l, limit=10):
+					self.assertEqual(len(left) + len(right), l)
+					self.assertTrue(parser.parse_nonterminal_context(left, nt, right))
+
+	def test_unrank(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		sampler = uniformsampler.UniformSampler(grammar, 8, mode="exact")
+		for nt in grammar.nonterminals:
+			for l in xrange(6):
+				yields = set()
+				for i in xrange(sampler.get(nt, l)):
+					t = sampler.unrank(nt, l, i)
+					self.assertEqual(sampler.rank(t), i)
+					self.assertEqual(tuple(t.collectYield()), sampler.unrank_yield(nt, l, i))
+					yields.add(sampler.unrank_yield(nt, l, i))
+				self.assertEqual(yields, set(sampler.enumerate_yields_from(nt, l)))
+		total = sampler.get_total(4)
+		self.assertEqual(len(list(sampler.sample_without_replacement(None, [4] * (total + 5)))), total)
+		with self.assertRaises(ValueError):
+			uniformsampler.UniformSampler(grammar, 8).unrank(None, 4, 0)
+
 	def test_density1(self):
 		grammar = cfg.load_from_file("../data/cfgs/cfg1.cfg")
 		sampler = uniformsampler.UniformSampler(grammar, 10)
@@ -448,4 +771,132 @@ class CfgTest(unittest.TestCase):
 		length_distribution = [0,1,0,10,0,10,0]
 		pcfg = generatepcfg.convert_cfg_lengths(grammar, length_distribution, count)
 		el = pcfg.isConsistent()
-		self.assertTrue(el < 5 and el > 3)
\ No newline at end of file
+		self.assertTrue(el < 5 and el > 3)
+
+	def test_grammar_index(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg3.cfg")
+		index = grammar.get_index()
+		for nt in grammar.nonterminals:
+			lhs = [ prod for prod in grammar.productions if prod[0] == nt ]
+			self.assertEqual(set(index.lhs_productions(nt)), set(lhs))
+			occurrences = sum(rhs.count(nt) for lhs, rhs in grammar.productions)
+			self.assertEqual(len(index.rhs_occurrences(nt)), occurrences)
+			self.assertEqual(grammar.count_productions_rhs(nt), occurrences)
+		self.assertTrue(index is grammar.get_index())
+		grammar.productions.add(("S", ("S", "S")))
+		self.assertFalse(index is grammar.get_index())
+
+	def test_intersection_witness(self):
+		grammar = cfg.load_from_file("../data/cfgs/abab2.cfg")
+		parser = earleyparser.EarleyParser(grammar)
+		w = ("a1","b1")
+		witness = grammar.infix_witness_without_nt(w, "O")
+		self.assertTrue(witness is not None)
+		self.assertTrue(parser.parse(witness))
+		grammar = cfg.load_from_file("../data/cfgs/cfg1.cfg")
+		self.assertTrue(grammar.infix_witness_without_nt(("ax","bx"), "S") is None)
+
+	def test_intersect_cfg_pruned(self):
+		grammar = cfg.load_from_file("../data/cfgs/abab2.cfg")
+		factory = generatecfg.CnfFactory()
+		factory.number_nonterminals = 5
+		factory.number_terminals = 3
+		factory.number_binary_productions = 12
+		factory.number_lexical_productions = 6
+		for g in [grammar] + [ factory.make_grammar() for i in xrange(5) ]:
+			terminals = sorted(g.terminals)
+			w = tuple(terminals[:2])
+			fa = finiteautomaton.make_infix(w, g.terminals)
+			self.assertEqual(fa.intersect_cfg(g, pruned=True).productions,
+				fa.intersect_cfg(g).trim().productions)
+			fa = finiteautomaton.make_infix_long(w, g.terminals)
+			for nt in g.nonterminals:
+				self.assertEqual(fa.intersect_cfg_remove(g, nt, pruned=True).productions,
+					fa.intersect_cfg_remove(g, nt).trim().productions)
+
+	def test_class_arcs(self):
+		grammar = cfg.ContextFreeGrammar()
+		grammar.nonterminals = set(["S"])
+		# d is not used by any production
+		grammar.terminals = set(["a", "b", "c", "d"])
+		grammar.start_set = set(["S"])
+		for prod in [("S",("S","S")), ("S",("a",)), ("S",("b",)), ("S",("c",))]:
+			grammar.productions.add(prod)
+		fa = finiteautomaton.make_infix(("a",), grammar.terminals, excluded=["b"])
+		self.assertEqual(fa.class_arcs, set([(0, 0, frozenset(["b"])), (1, 1, frozenset(["b"]))]))
+		self.assertEqual(sorted(fa.expanded_arcs(["a", "b"])), [(0, 0, "a"), (0, 1, "a"), (1, 1, "a")])
+		for pruned in (False, True):
+			ntmap = dict()
+			product = fa.intersect_cfg(grammar, ntmap, pruned=pruned)
+			names = dict((name, triple) for triple, name in ntmap.iteritems())
+			lexical = set(names[lhs] for lhs, rhs in product.productions
+				if len(rhs) == 1 and rhs[0] in grammar.terminals)
+			self.assertEqual(lexical, set([(0, 0, "a"), (0, 0, "c"), (0, 1, "a"), (1, 1, "a"), (1, 1, "c")]))
+			for lhs, rhs in product.productions:
+				self.assertFalse("d" in rhs)
+			self.assertTrue(product.trim().productions)
+
+	def test_indexed_parser(self):
+		factory = generatecfg.CfgFactory()
+		factory.number_nonterminals = 4
+		factory.number_terminals = 3
+		factory.number_productions = 10
+		factory.max_rhs_length = 3
+		factory.no_unary_nt = False
+		for i in xrange(5):
+			grammar = factory.make_grammar()
+			if not grammar.terminals:
+				continue
+			# and an empty production
+			grammar.productions.add((random.choice(list(grammar.nonterminals)), ()))
+			indexed = earleyparser.EarleyParser(grammar)
+			plain = earleyparser.EarleyParser(grammar, indexed=False)
+			terminals = list(grammar.terminals)
+			nonterminals = list(grammar.nonterminals)
+			for j in xrange(50):
+				w = tuple(random.choice(terminals) for k in xrange(random.randint(0,6)))
+				nt = random.choice(nonterminals)
+				self.assertEqual(indexed.parse(w), plain.parse(w))
+				self.assertEqual(indexed.parse_start(w, nt), plain.parse_start(w, nt))
+				self.assertEqual(indexed.parse_nonterminal_context(w[:1], nt, w[1:]),
+					plain.parse_nonterminal_context(w[:1], nt, w[1:]))
+
+	def test_cky_parser(self):
+		"""
+		The CKY recogniser agrees with the Earley parser on CNF grammars.
+		"""
+		factory = generatecfg.CnfFactory()
+		factory.number_nonterminals = 5
+		factory.number_terminals = 4
+		factory.number_binary_productions = 15
+		factory.number_lexical_productions = 8
+		grammar = factory.make_grammar()
+		self.assertTrue(grammar.is_cnf())
+		earley = earleyparser.EarleyParser(grammar)
+		cky = ckyparser.CkyParser(grammar)
+		terminals = list(grammar.terminals)
+		for i in xrange(100):
+			w = tuple(random.choice(terminals) for j in xrange(random.randint(0,8)))
+			self.assertEqual(earley.parse(w), cky.parse(w))
+			self.assertEqual(earley.parse_start(w, "NT0"), cky.parse_start(w, "NT0"))
+			self.assertEqual(earley.parse_nonterminal_context(w[:2], "NT1", w[2:]),
+				cky.parse_nonterminal_context(w[:2], "NT1", w[2:]))
+
+	def test_parse_many(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		parser = earleyparser.EarleyParser(grammar)
+		strings = [("ax","ax","ax","bx","bx","bx"), ("ax","bx"), ("ax","ay","ax","bx","by","bx"),
+			("ax","ay","ax","bx","by"), ("ax",), ()]
+		self.assertEqual(parser.parse_many(strings), [ parser.parse(w) for w in strings ])
+		self.assertEqual(parser.parse_many(strings), [True, True, True, False, False, True])
+
+	def test_membership_cache(self):
+		grammar = cfg.load_from_file("../data/cfgs/cfg2.cfg")
+		cache = membershipcache.MembershipCache(2)
+		parser = earleyparser.EarleyParser(grammar, cache=cache)
+		strings = [("ax","bx"), ("ax","bx"), ("ax","bx","bx"), ("ax",), ("ax","bx")]
+		self.assertEqual([ parser.parse(w) for w in strings ], [True, True, False, False, True])
+		self.assertEqual(cache.hits, 1)
+		self.assertEqual(cache.misses, 4)
+		self.assertEqual(len(cache.table), 2)
+		self.assertEqual(grammar.fingerprint(), grammar.copy().fingerprint())
@@ -1,39 +1,80 @@
+import array
+import collections
+import itertools
 import numpy
 import string
 
-class TreeNode:
+class TreeNode(object):
+	"""
+	A node of a derivation tree. Leaves are the nodes without daughters
+	whose label starts with a lower case letter.
+
+	All the traversals use explicit stacks, so deep trees do not run into
+	the recursion limit.
+	"""
+
+	__slots__ = ('label', 'daughters', '_lower')
 
 	def __init__(self,label):
 		self.label = label
 		self.daughters = []
+		# whether the label could be a leaf; labels are not changed and
+		# the labels of binarised productions are tuples.
+		self._lower = isinstance(label, basestring) and label[:1].islower()
+
+	def preorder(self):
+		"""
+		Generate the nodes of this tree, mothers before daughters and
+		left to right.
+		"""
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			yield node
+			stack.extend(reversed(node.daughters))
 
 	def depth(self):
-		if self.isLeaf():
-			return 0
-		else:
-			return 1 + max([ d.depth() for d in self.daughters])
+		result = 0
+		stack = [ (self, 0) ]
+		while stack:
+			node, d = stack.pop()
+			if d > result:
+				result = d
+			for daughter in node.daughters:
+				stack.append((daughter, d + 1))
+		return result
 
 	def width(self):
-		if self.isLeaf():
-			return 1
-		else:
-			w = 0
-			for d in self.daughters:
-				w += d.width()
-			return w
+		w = 0
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if node.daughters:
+				stack.extend(node.daughters)
+			elif node._lower:
+				w += 1
+		return w
 
 	def dump(self):
-		print "(", self.label, 
-		for daughter in self.daughters:
-			daughter.dump()
-		print ")",
+		# a daughter or None for the closing bracket
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if node is None:
+				print ")",
+			else:
+				print "(", node.label,
+				stack.append(None)
+				stack.extend(reversed(node.daughters))
 
 	def yield1(self, current):
-		if self.isLeaf():
-			current.append(self.label)
-		else:
-			for daughter in self.daughters:
-				daughter.yield1(current)
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if node.daughters:
+				stack.extend(reversed(node.daughters))
+			elif node._lower:
+				current.append(node.label)
 
 	def collectYield(self):
 		current = []
@@ -46,30 +87,68 @@ class TreeNode:
 		return current
 
 	def collectPreterminals1(self,current):
-		if not self.isLeaf() and len(self.daughters) == 1 and self.daughters[0].isLeaf():
-			current.append(self.label)
-			return
-		if not self.isLeaf():
-			for d in self.daughters:
-				d.collectPreterminals1(current)
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if node.isLeaf():
+				continue
+			if len(node.daughters) == 1 and node.daughters[0].isLeaf():
+				current.append(node.label)
+			else:
+				stack.extend(reversed(node.daughters))
 
 	def collect_contexts_of_nt(self,nonterminal):
 		"""
-		Returns a list of all contexts of nonterminal in this tree.
-		If there are none then the list is empty.
+		Returns a list of all contexts of nonterminal in this tree,
+		in preorder. If there are none then the list is empty.
+		"""
+		w, spans = self.yield_spans()
+		return [ (w[:start], w[end:]) for node, start, end in spans if node.label == nonterminal ]
+
+	def collect_all_contexts(self):
+		"""
+		Returns a map from each label of a node that is not a leaf to the
+		list of its contexts in this tree, in preorder.
 		"""
-		occurrences = set()
-		self.find_nt_occurrences(nonterminal,occurrences)
-		answer = []
-		for subtree in occurrences:
-			answer.append(self.collect_context_of_subtree(subtree))
-		return answer
+		w, spans = self.yield_spans()
+		answer = collections.defaultdict(list)
+		for node, start, end in spans:
+			if not node.isLeaf():
+				answer[node.label].append((w[:start], w[end:]))
+		return dict(answer)
+
+	def yield_spans(self):
+		"""
+		Returns the yield as a tuple and a list of (node, start, end) in
+		preorder, where yield[start:end] is the yield of node, in one pass.
+		"""
+		current = []
+		nodes = []
+		starts = []
+		ends = []
+		# a daughter, or the position in nodes of a node to close
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if type(node) is int:
+				ends[node] = len(current)
+				continue
+			nodes.append(node)
+			starts.append(len(current))
+			ends.append(None)
+			if node.daughters:
+				stack.append(len(nodes) - 1)
+				stack.extend(reversed(node.daughters))
+			else:
+				if node._lower:
+					current.append(node.label)
+				ends[-1] = len(current)
+		return tuple(current), zip(nodes, starts, ends)
 
 	def find_nt_occurrences(self,nonterminal,occurrences):
-		if self.label == nonterminal:
-			occurrences.add(self)
-		for d in self.daughters:
-			d.find_nt_occurrences(nonterminal,occurrences)
+		for node in self.preorder():
+			if node.label == nonterminal:
+				occurrences.add(node)
 
 	def collect_context_of_subtree(self,subtree):
 		"""
@@ -88,53 +167,216 @@ class TreeNode:
 		"""
 		Returns True once we have passed the occurrence of the subtree.
 		"""
-		if self == subtree:
-			# we are in the middle
-			if passed:
-				raise ValueError("This subtree occurs twice in this tree.")
-			else:
-				return True
-		elif passed:
-			# then we attach to the right
-			if self.isLeaf():
-				right.append(self.label)
-			else:
-				for d in self.daughters:
-					d.collect_context_of_subtree_lr(subtree,left,right,passed)
-		else:
-			# not passed
-			if self.isLeaf():
-				left.append(self.label)
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if node == subtree:
+				# we are in the middle
+				if passed:
+					raise ValueError("This subtree occurs twice in this tree.")
+				passed = True
+			elif node.isLeaf():
+				if passed:
+					right.append(node.label)
+				else:
+					left.append(node.label)
 			else:
-				for d in self.daughters:
-					# we may pass in one of the daughters so we update passed
-					passed = d.collect_context_of_subtree_lr(subtree,left,right,passed)
-
+				stack.extend(reversed(node.daughters))
 		return passed
 
 	def isLeaf(self):
 		"""
 		return true if this is a leaf
 		"""
-		return len(self.daughters) == 0 and self.label[0].islower()
+		return self._lower and not self.daughters
 
 	def storeTreeToFile(self,fileobject):
 		"""Store it in bracketed format on one line"""
-		if self.isLeaf():
-			fileobject.write(self.label + " ")
-		else:
-			fileobject.write("( " + self.label + " ")
-			for daughter in self.daughters:
-				daughter.storeTreeToFile(fileobject)
-			fileobject.write(" )")
+		# a daughter or None for the closing bracket
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if node is None:
+				fileobject.write(" )")
+			elif node.isLeaf():
+				fileobject.write(node.label + " ")
+			else:
+				fileobject.write("( " + node.label + " ")
+				stack.append(None)
+				stack.extend(reversed(node.daughters))
 
 	def count_productions(self, counter):
-		if not self.isLeaf():
-			rhs = [ x.label for x in self.daughters]
-			prod = (self.label,tuple(rhs))
-			counter[prod] += 1
-			for x in self.daughters:
-				x.count_productions(counter)
+		for node in self.preorder():
+			if not node.isLeaf():
+				rhs = [ x.label for x in node.daughters]
+				prod = (node.label,tuple(rhs))
+				counter[prod] += 1
+
+	def flatten(self, symbols=None, symbol_ids=None):
+		"""
+		This tree as a FlatTree.
+		"""
+		return FlatTree(self, symbols, symbol_ids)
+
+
+class FlatTree(object):
+	"""
+	A tree stored as flat arrays in preorder: for each node the id of its
+	label, its number of daughters and the number of nodes in its subtree,
+	itself included.  Node 0 is the root; the first daughter of node i is
+	i + 1 and each daughter j is followed by its next sister at
+	j + size[j].
+
+	symbols is the list of labels and symbol_ids the map back to the ids.
+	The tables given are never changed: a label not in them is added to
+	copies, which this tree then keeps. Trees whose labels are all in the
+	tables, e.g. the symbols of a cfg.GrammarIndex, share them.
+	"""
+
+	__slots__ = ('labels', 'arity', 'size', 'leaf', 'symbols', 'symbol_ids')
+
+	def __init__(self, node, symbols=None, symbol_ids=None):
+		# whether symbols and symbol_ids are ours to extend
+		owned = symbols is None and symbol_ids is None
+		if symbols is None:
+			symbols = []
+		if symbol_ids is None:
+			symbol_ids = dict((s, i) for i, s in enumerate(symbols))
+		self.labels = array.array('i')
+		self.arity = array.array('i')
+		self.leaf = bytearray()
+		mothers = []
+		stack = [ (node, -1) ]
+		while stack:
+			node, mother = stack.pop()
+			label = node.label
+			s = symbol_ids.get(label)
+			if s is None:
+				if not owned:
+					symbols = list(symbols)
+					symbol_ids = dict(symbol_ids)
+					owned = True
+				s = len(symbols)
+				symbols.append(label)
+				symbol_ids[label] = s
+			i = len(self.labels)
+			self.labels.append(s)
+			self.arity.append(len(node.daughters))
+			self.leaf.append(node.isLeaf())
+			mothers.append(mother)
+			stack.extend((d, i) for d in reversed(node.daughters))
+		size = array.array('i', [1]) * len(mothers)
+		for i in xrange(len(mothers) - 1, 0, -1):
+			size[mothers[i]] += size[i]
+		self.size = size
+		self.symbols = symbols
+		self.symbol_ids = symbol_ids
+
+	def __len__(self):
+		return len(self.labels)
+
+	def label(self, i):
+		return self.symbols[self.labels[i]]
+
+	def daughters(self, i):
+		"""
+		The positions of the daughters of node i.
+		"""
+		result = []
+		j = i + 1
+		for k in xrange(self.arity[i]):
+			result.append(j)
+			j += self.size[j]
+		return result
+
+	def depth(self):
+		result = 0
+		# the number of daughters still to come of each node on the path
+		path = []
+		for a in self.arity:
+			if len(path) > result:
+				result = len(path)
+			if a:
+				path.append(a)
+			else:
+				while path:
+					path[-1] -= 1
+					if path[-1]:
+						break
+					path.pop()
+		return result
+
+	def width(self):
+		return sum(self.leaf)
+
+	def collectYield(self):
+		symbols = self.symbols
+		return [ symbols[s] for s, leaf in itertools.izip(self.labels, self.leaf) if leaf ]
+
+	def collectPreterminals(self):
+		leaf = self.leaf
+		return [ self.label(i) for i in xrange(len(self))
+			if self.arity[i] == 1 and leaf[i + 1] ]
+
+	def collect_contexts_of_nt(self, nonterminal):
+		"""
+		Returns a list of all contexts of nonterminal in this tree, in
+		preorder, in one pass over the arrays.
+		"""
+		s = self.symbol_ids.get(nonterminal)
+		if s is None:
+			return []
+		w, starts = self.yield_starts()
+		size = self.size
+		return [ (w[:starts[i]], w[starts[i + size[i]]:])
+			for i, label in enumerate(self.labels) if label == s ]
+
+	def collect_all_contexts(self):
+		"""
+		Returns a map from each label of a node that is not a leaf to the
+		list of its contexts in this tree, in preorder.
+		"""
+		w, starts = self.yield_starts()
+		size = self.size
+		answer = collections.defaultdict(list)
+		for i, label in enumerate(self.labels):
+			if not self.leaf[i]:
+				answer[self.symbols[label]].append((w[:starts[i]], w[starts[i + size[i]]:]))
+		return dict(answer)
+
+	def yield_starts(self):
+		"""
+		Returns the yield as a tuple and the number of leaves before each
+		node, and at the end the width, so that the yield of node i is
+		yield[starts[i]:starts[i + size[i]]].
+		"""
+		w = []
+		starts = array.array('i')
+		symbols = self.symbols
+		for label, leaf in itertools.izip(self.labels, self.leaf):
+			starts.append(len(w))
+			if leaf:
+				w.append(symbols[label])
+		starts.append(len(w))
+		return tuple(w), starts
+
+	def count_productions(self, counter):
+		for i in xrange(len(self)):
+			if not self.leaf[i]:
+				rhs = tuple(self.label(j) for j in self.daughters(i))
+				counter[(self.label(i), rhs)] += 1
+
+	def to_tree(self):
+		"""
+		This tree as TreeNodes.
+		"""
+		nodes = []
+		for s in self.labels:
+			nodes.append(TreeNode(self.symbols[s]))
+		for i, node in enumerate(nodes):
+			node.daughters = [ nodes[j] for j in self.daughters(i) ]
+		return nodes[0]
+
 
 def storeYieldToFile(node,file_object):
 	yieldlist = node.collectYield()
@@ -4,24 +4,152 @@
 # do a topological sort of the nonterminals and productions first.
 # binarise grammar and then debinarise the trees.
 # sample uniformly from derivations of a given length.
+#
+# Counts can be kept in three ways (the mode):
+# "float" -- floats; fast but sampling is no longer uniform above 2^53.
+# "exact" -- Python ints in object arrays; exact but slower.
+# "log" -- natural logs of the counts as floats; fast and never overflows.
+#
+# The tables can be kept in a cache directory between runs, as .npy files
+# named by the grammar's fingerprint, the mode and the maximum length.
+# Float and log tables are opened read-only with mmap, so several processes
+# share the same pages; exact tables hold Python ints and are read in full.
 
 
+import bisect
 import collections
+import itertools
+import math
 import numpy as np
+import operator
+import os
 import random
 import logging
+import tempfile
 
 import cfg 
+import tarjan
 import tree
-import earleyparser
+import countingparser
+
+modes = ("float", "exact", "log")
+
+
+def normalise(counts):
+	"""
+	Return a list of floats proportional to these counts that sums to 1.
+	Safe for very large integer counts.
+	"""
+	total = sum(counts)
+	return [ operator.truediv(x, total) for x in counts ]
+
+
+def _groups(codes):
+	"""
+	Group equal values of an integer array.
+	Yields (indices, value) for every distinct value.
+	"""
+	if not len(codes):
+		return
+	first = codes[0]
+	if len(codes) == 1 or (codes == first).all():
+		yield np.arange(len(codes)), first
+		return
+	order = np.argsort(codes, kind='mergesort')
+	ordered = codes[order]
+	bounds = np.flatnonzero(ordered[1:] != ordered[:-1]) + 1
+	begin = 0
+	for end in list(bounds) + [len(codes)]:
+		yield order[begin:end], ordered[begin]
+		begin = end
+
+
+def _distinct(items, limit):
+	"""
+	Generate the items without repeats, stopping after limit of them.
+	"""
+	seen = set()
+	if limit is not None and limit <= 0:
+		return
+	for item in items:
+		if not item in seen:
+			seen.add(item)
+			yield item
+			if len(seen) == limit:
+				return
+
+
+# part of the name of every cached table; bump it whenever the way the
+# tables are computed or stored changes, so old files are not reused.
+cache_version = 2
+
+# the type that cached tables of each mode are stored with.
+cache_dtypes = { "float" : np.float64, "log" : np.float64, "exact" : np.int64 }
+
+
+def _cache_path(cache_dir, kind, grammar, mode, max_length):
+	return os.path.join(cache_dir, "%s-v%d-%s-%s-%d.npy" % (kind, cache_version, grammar.fingerprint(), mode, max_length))
+
+
+def _load_table(path, mode, shape):
+	"""
+	Return the table stored at path, or None if there is no usable one.
+	Nothing is ever unpickled.  Exact counts are stored as 64 bit
+	integers and turned back into Python ints, so they cannot overflow
+	later on.
+	"""
+	if not os.path.exists(path):
+		return None
+	try:
+		table = np.load(path, mmap_mode='r', allow_pickle=False)
+	except (IOError, ValueError) as e:
+		logging.warning("Ignoring unreadable cached table %s: %s", path, e)
+		return None
+	if table.shape != shape or table.dtype != cache_dtypes[mode]:
+		logging.warning("Ignoring cached table %s of the wrong shape or type", path)
+		return None
+	if mode == "exact":
+		return table.astype(object)
+	# a plain array over the mapped pages; memmap slices are slow.
+	return table.view(np.ndarray)
+
+
+def _store_table(path, table):
+	"""
+	Write the table to path; it is written to a temporary file first and
+	renamed, so other processes never see a partial file.  Exact tables
+	with counts that do not fit in 64 bits are not stored.
+	"""
+	if table.dtype == object:
+		if table.size and max(table.flat) >= 2 ** 63:
+			logging.info("Not caching table %s: the counts are too big", path)
+			return
+		table = table.astype(np.int64)
+	try:
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+		with os.fdopen(fd, "wb") as f:
+			np.save(f, table)
+		os.rename(tmp, path)
+	except (IOError, OSError) as e:
+		logging.warning("Could not cache table %s: %s", path, e)
+
 
 class UniformSampler:
 	"""
 	Stores data structures that contain counts and indices.
 	"""
 
-	def __init__(self, grammar, max_length):
+	def __init__(self, grammar, max_length, mode="float", cache_dir=None):
 		#print "Initialising uniform sampler"
+		if not mode in modes:
+			raise ValueError("unknown counting mode " + str(mode))
+		self.mode = mode
+		if mode == "float":
+			self.zero, self.one = 0.0, 1.0
+		elif mode == "exact":
+			self.zero, self.one = 0, 1
+		else:
+			self.zero, self.one = -np.inf, 0.0
 		# map from nonterminals to 
 		self.index = dict()
 		self.grammar = grammar
@@ -35,7 +163,7 @@ class UniformSampler:
 		#print "Sorted ", sortednts
 		self.productions = []
 		prodmap = collections.defaultdict(list)
-		nts = set()
+		nts = []
 		# prodindex maps nonterminals to a list of productions.
 		self.prodindex = collections.defaultdict(list)
 		for prod in grammar.productions:
@@ -48,31 +176,82 @@ class UniformSampler:
 				for bprod in cfg.binarise_production(prod):
 					#print bprod
 					self.productions.append(bprod)
-					self.index[bprod] = [0.0] * (max_length + 1)
-					nts.add(bprod[0])
+					if not bprod[0] in self.prodindex:
+						nts.append(bprod[0])
 					self.prodindex[bprod[0]].append(bprod)
 					
 		self.max_length = max_length
-		for n in nts:
-			#print "Uniform sampler: nonterminal ", nt
-			self.index[n] = [0.0] * (max_length + 1)
-		for n in grammar.terminals:
-			self.index[n] = [0.0] * (max_length + 1)
-			# set length 1 to be 1 for uniformity
-			self.index[n][1]  = 1
-		# all set for the recursion
-		for i in xrange(max_length + 1):
-			#print "computing ", i
-			self._compute(i)
+		# cumulative counts for sampling, keyed by (symbol or production, length);
+		# the start symbols use None.
+		self.cumulative = dict()
+		# and their numpy versions for batch sampling
+		self.batch_cumulative = dict()
+		# the counts live in one table with a row for every symbol and
+		# every binarised production; index maps each of them to its row.
+		self.rows = dict()
+		self.keys = []
+		for key in nts + sorted(grammar.terminals) + self.productions:
+			if not key in self.rows:
+				self.rows[key] = len(self.keys)
+				self.keys.append(key)
+		table = None
+		if cache_dir is not None:
+			# a cached table has its rows in a canonical order.
+			self.keys.sort(key=repr)
+			for row, key in enumerate(self.keys):
+				self.rows[key] = row
+			path = _cache_path(cache_dir, "uniform", grammar, mode, max_length)
+			table = _load_table(path, mode, (len(self.keys), max_length + 1))
+		if table is not None:
+			self.table = table
+			for key, row in self.rows.iteritems():
+				self.index[key] = self.table[row]
+			self._prepare_rules()
+			self._set_same_length()
+		else:
+			self.table = self._zeros((len(self.keys), max_length + 1))
+			for key, row in self.rows.iteritems():
+				self.index[key] = self.table[row]
+			for n in grammar.terminals:
+				# set length 1 to be 1 for uniformity
+				self.index[n][1]  = self.one
+			self._prepare_rules()
+			# all set for the recursion
+			for i in xrange(max_length + 1):
+				#print "computing ", i
+				self._compute(i)
+			if cache_dir is not None:
+				_store_table(path, self.table)
 		#self.dump()
 		# now compute some totals which are useful for sampling.
-		self.start_totals = [0.0] * (max_length + 1)
-		for i in xrange(max_length + 1):
-			for s in self.grammar.start_set:
-				self.start_totals[i] += self.index[s][i]
+		self.start_totals = self._zeros(max_length + 1)
+		for s in self.grammar.start_set:
+			self.start_totals = self._add(self.start_totals, self.index[s])
 		
 
 
+	def extend_to(self, max_length):
+		"""
+		Grow the tables to cover lengths up to max_length, computing only
+		the new lengths.
+		"""
+		old = self.max_length
+		if max_length <= old:
+			return
+		table = self._zeros((len(self.keys), max_length + 1))
+		table[:, :old + 1] = self.table
+		self.table = table
+		for key, row in self.rows.iteritems():
+			self.index[key] = table[row]
+		self.max_length = max_length
+		for i in xrange(old + 1, max_length + 1):
+			self._compute(i)
+		totals = self._zeros(max_length + 1)
+		totals[:old + 1] = self.start_totals
+		for s in self.grammar.start_set:
+			totals[old + 1:] = self._add(totals[old + 1:], self.index[s][old + 1:])
+		self.start_totals = totals
+
 	def dump(self):
 		"""
 		Just for debugging, dump the indices.
@@ -83,27 +262,282 @@ class UniformSampler:
 			for i,v in enumerate(a):
 				print i, v
 
+	def _zeros(self, shape):
+		if self.mode == "exact":
+			result = np.empty(shape, dtype=object)
+			result.fill(0)
+			return result
+		return np.full(shape, self.zero)
 
-	def _compute(self, length):
+	def _add(self, a, b):
 		"""
-		Compute this for strings of this length.  
+		Sum of two counts (or arrays of counts) in this mode.
+		"""
+		if self.mode == "log":
+			return np.logaddexp(a, b)
+		return a + b
+
+	def _mul(self, a, b):
 		"""
+		Product of two counts (or arrays of counts) in this mode.
+		"""
+		if self.mode == "log":
+			return a + b
+		return a * b
+
+	def _value(self, count):
+		"""
+		Turn a stored count into a number.
+		"""
+		if self.mode == "log":
+			return float(np.exp(count))
+		return count
+
+	def _log(self, count):
+		"""
+		Turn a stored count into its natural log.
+		"""
+		if self.mode == "log":
+			return float(count)
+		if count == 0:
+			return -np.inf
+		return math.log(count)
+
+	def _choose(self, cache, key, choices, empty="Sampling from empty"):
+		"""
+		Pick one of the (item, count) pairs returned by choices() with
+		probability proportional to its count.
+
+		The cumulative counts are built on the first draw for a key and
+		kept in cache, so later draws are a binary search.
+		Raises ValueError(empty) if all the counts are zero.
+		"""
+		return self._draw(self._table(cache, key, choices, empty))
+
+	def _draw(self, table):
+		items, cumulative = table
+		if len(items) == 1:
+			return items[0]
+		if self.mode == "exact":
+			r = random.randrange(cumulative[-1])
+		else:
+			r = random.random() * cumulative[-1]
+		return items[bisect.bisect_right(cumulative, r)]
+
+	def _draw_many(self, table, k, array=None):
+		"""
+		Draw k independent items from a table at once.
+		Returns an array of indices into its items.
+		array is the table's cumulative counts as from _cumulative_array.
+		"""
+		items, cumulative = table
+		if len(items) == 1:
+			return np.zeros(k, dtype=int)
+		if array is None:
+			array = self._cumulative_array(cumulative)
+		if array is None:
+			# too big for numpy integers
+			return np.array([ bisect.bisect_right(cumulative, random.randrange(cumulative[-1]))
+				for j in xrange(k) ], dtype=int)
+		if self.mode == "exact":
+			r = np.random.randint(0, cumulative[-1], size=k)
+		else:
+			r = np.random.random(k) * cumulative[-1]
+		return np.minimum(np.searchsorted(array, r, side='right'), len(items) - 1)
+
+	def _cumulative_array(self, cumulative):
+		"""
+		The cumulative counts of a table as a numpy array, or None when
+		exact counts do not fit in 64 bits.
+		"""
+		if self.mode == "exact":
+			if cumulative[-1] >= 2 ** 62:
+				return None
+			return np.array(cumulative, dtype=np.int64)
+		return np.array(cumulative)
+
+	def _table(self, cache, key, choices, empty="Sampling from empty"):
+		"""
+		Return the cached (items, cumulative counts) for this key,
+		building it from choices() if needed.
+		"""
+		table = cache.get(key)
+		if table is None:
+			table = self._cumulative(choices())
+			if table is None:
+				raise ValueError(empty)
+			cache[key] = table
+		return table
+
+	def _cumulative(self, choices):
+		"""
+		Return the items with non-zero counts and the running totals of
+		their counts, or None if there are none.
+		In log mode the totals are scaled so the largest count is 1.
+		"""
+		choices = [ (item, count) for item, count in choices if count != self.zero ]
+		if not choices:
+			return None
+		if self.mode == "log":
+			scale = max(count for item, count in choices)
+			counts = [ math.exp(count - scale) for item, count in choices ]
+		elif self.mode == "float":
+			# plain floats are much quicker to bisect than numpy scalars
+			counts = [ float(count) for item, count in choices ]
+		else:
+			counts = [ count for item, count in choices ]
+		cumulative = []
+		running = 0
+		for count in counts:
+			running += count
+			cumulative.append(running)
+		return ([ item for item, count in choices ], cumulative)
+
+	def _prepare_rules(self):
+		"""
+		Split the productions into the ones whose counts at a length only
+		depend on shorter lengths, which are computed with array operations,
+		and the rest, which are done one at a time in topological order.
+		"""
+		rows = self.rows
+		terminals = self.grammar.terminals
+		binary = [ prod for prod in self.productions if len(prod[1]) == 2 ]
+		lexical = [ prod for prod in self.productions
+			if len(prod[1]) == 1 and prod[1][0] in terminals ]
+		self.binary_rows = np.array([ rows[prod] for prod in binary ], dtype=int)
+		self.binary_lhs = np.array([ rows[prod[0]] for prod in binary ], dtype=int)
+		self.binary_left = np.array([ rows[prod[1][0]] for prod in binary ], dtype=int)
+		self.binary_right = np.array([ rows[prod[1][1]] for prod in binary ], dtype=int)
+		self.lexical_rows = np.array([ rows[prod] for prod in lexical ], dtype=int)
+		self.lexical_lhs = np.array([ rows[prod[0]] for prod in lexical ], dtype=int)
+		self.lexical_terminal = np.array([ rows[prod[1][0]] for prod in lexical ], dtype=int)
+		# (row, lhs row, rhs rows) for every production, in topological order.
+		self.sequential = [ (rows[prod], rows[prod[0]], tuple(rows[x] for x in prod[1]))
+			for prod in self.productions ]
+		self._set_empty_order()
+		# filled in once the counts of length 0 are known.
+		self.same_length = None
+		# for batch sampling: number of daughters and the daughters' rows of
+		# every production row, and which rows are terminals.
+		nrows = len(self.keys)
+		self.is_terminal = np.zeros(nrows, dtype=bool)
+		for t in terminals:
+			self.is_terminal[rows[t]] = True
+		self.arity = np.zeros(nrows, dtype=int)
+		self.first = np.zeros(nrows, dtype=int)
+		self.second = np.zeros(nrows, dtype=int)
 		for prod in self.productions:
-			## these are in the right order
+			row = rows[prod]
 			rhs = prod[1]
+			self.arity[row] = len(rhs)
+			if len(rhs) > 0:
+				self.first[row] = rows[rhs[0]]
+			if len(rhs) > 1:
+				self.second[row] = rows[rhs[1]]
+
+	def _compute(self, length):
+		"""
+		Compute this for strings of this length.  
+
+		Splits where both sides are non-empty only use shorter lengths, so
+		they are computed for all binary productions at once.  What is left
+		are unary productions and nullable daughters, which need counts of
+		the same length and so are added in topological order.
+		"""
+		table = self.table
+		add = self._add
+		mul = self._mul
+		if length == 0:
+			rules = self.sequential
+		else:
+			column = table[:, length]
+			left = table[self.binary_left, 1:length]
+			right = table[self.binary_right, length-1:0:-1]
+			lexical = table[self.lexical_terminal, length]
+			if self.mode == "float":
+				strict = np.einsum('ij,ij->i', left, right)
+				column += np.bincount(self.binary_lhs, weights=strict, minlength=len(self.keys))
+				column += np.bincount(self.lexical_lhs, weights=lexical, minlength=len(self.keys))
+			elif self.mode == "exact":
+				strict = (left * right).sum(axis=1)
+				np.add.at(column, self.binary_lhs, strict)
+				np.add.at(column, self.lexical_lhs, lexical)
+			else:
+				strict = np.logaddexp.reduce(left + right, axis=1)
+				np.logaddexp.at(column, self.binary_lhs, strict)
+				np.logaddexp.at(column, self.lexical_lhs, lexical)
+			table[self.binary_rows, length] = strict
+			table[self.lexical_rows, length] = lexical
+			rules = self.same_length
+		for row, lhs, rhs in rules:
 			rhsl = len(rhs)
-			increment = 0
+			increment = self.zero
 			if rhsl == 2:
-				for left in xrange(length+1):
-					right = length - left
-					increment += self.index[rhs[0]][left] * self.index[rhs[1]][right]
+				if length == 0:
+					increment = mul(table[rhs[0], 0], table[rhs[1], 0])
+				else:
+					increment = add(mul(table[rhs[0], 0], table[rhs[1], length]),
+						mul(table[rhs[0], length], table[rhs[1], 0]))
 			if rhsl == 1:
-				increment = self.index[rhs[0]][length]
+				increment = table[rhs[0], length]
 			if rhsl == 0:
 				if length == 0:
-					increment = 1
-			self.index[prod][length] = increment
-			self.index[prod[0]][length] += increment
+					increment = self.one
+			table[row, length] = add(table[row, length], increment)
+			table[lhs, length] = add(table[lhs, length], increment)
+		if length == 0:
+			self._set_same_length()
+
+	def _set_empty_order(self):
+		"""
+		Order the productions for length 0 so that every nullable symbol is
+		finished before it is used.  The topological sort of the grammar
+		only follows unary rules, so it can put a production before one
+		of its nullable daughters.
+		"""
+		rows = self.rows
+		binarised = cfg.ContextFreeGrammar()
+		binarised.productions = set(self.productions)
+		nullable = set(rows[x] for x in binarised.compute_nullable())
+		graph = collections.defaultdict(list)
+		for row, lhs, rhs in self.sequential:
+			if all(x in nullable for x in rhs):
+				graph[lhs].extend(rhs)
+		position = dict()
+		for i, scc in enumerate(tarjan.strongly_connected_components(dict(graph))):
+			for x in scc:
+				position[x] = i
+		# the other productions have nothing to add at length 0
+		self.sequential.sort(key = lambda rule: position.get(rule[1], -1))
+
+	def _set_same_length(self):
+		"""
+		Pick out the productions that need counts of the same length and
+		order them so that every symbol is finished before it is used.
+		The topological sort of the grammar does not see the binarised
+		symbols next to a nullable daughter, so sort again here.
+		"""
+		table = self.table
+		lexical = set(self.lexical_rows)
+		rules = []
+		graph = collections.defaultdict(list)
+		for row, lhs, rhs in self.sequential:
+			if len(rhs) == 1 and not row in lexical:
+				graph[lhs].append(rhs[0])
+			elif len(rhs) == 2 and (table[rhs[0], 0] != self.zero or table[rhs[1], 0] != self.zero):
+				if table[rhs[0], 0] != self.zero:
+					graph[lhs].append(rhs[1])
+				if table[rhs[1], 0] != self.zero:
+					graph[lhs].append(rhs[0])
+			else:
+				continue
+			rules.append((row, lhs, rhs))
+		position = dict()
+		for i, scc in enumerate(tarjan.strongly_connected_components(dict(graph))):
+			for x in scc:
+				position[x] = i
+		rules.sort(key = lambda rule: position[rule[1]])
+		self.same_length = rules
 	
 
 	def density(self, length):
@@ -114,9 +548,11 @@ class UniformSampler:
 		
 		Throws exception if grammar is empty.
 		"""
+		if self.mode == "log":
+			return math.exp(self.start_totals[length] - length * math.log(self.vocab))
 		derivations = self.get_total(length)
 		strings = self.vocab ** length
-		return derivations/strings
+		return operator.truediv(derivations, strings)
 
 
 	def string_density(self,length, samples):
@@ -129,17 +565,15 @@ class UniformSampler:
 
 		strings = 1.0 * self.vocab ** length
 		total = 0.0
-		parser = earleyparser.EarleyParser(self.grammar)
+		parser = countingparser.CountingParser(self.grammar)
 			
 		for i in xrange(samples):
 
 			tree = self.sample(length)
-			w = tree.collectYield()
-			print w
+			w = tuple(tree.collectYield())
 			#print w
 			
 			n = parser.count_parses(w)
-			print n
 			if n == 0:
 				tree.dump()
 				print "Bad number of parses", n
@@ -158,15 +592,18 @@ class UniformSampler:
 
 
 	def get_total(self,length):
-		derivations = 0.0
-		for s in self.grammar.start_set:
-			derivations += self.index[s][length]
-		return derivations
+		return self._value(self.start_totals[length])
+
+	def get_log_total(self, length):
+		"""
+		return the natural log of the number of derivations of this length.
+		"""
+		return self._log(self.start_totals[length])
 
 
 	def _get_shortest_length(self, nonterminal):
 		for i in xrange(self.max_length):
-			if self.index[nonterminal][i] > 0:
+			if self.index[nonterminal][i] != self.zero:
 				return i
 		return -1
 
@@ -175,12 +612,12 @@ class UniformSampler:
 			return True
 		else:
 			self.shortest_yield = dict()
-			for nt in self.nonterminals:
-				l = self.get_shortest_length(nonterminal)
+			for nt in self.grammar.nonterminals:
+				l = self._get_shortest_length(nt)
 				if l == -1:
 					raise ValueError("No short yields")
 				else:
-					self.shortest_yield[nt] = self.sample_from_nonterminal(nonterminal,l).collectYield()
+					self.shortest_yield[nt] = self.sample_yield_from(nt,l)
 		return True
 
 	def get_a_shortest_yield(self,nonterminal):
@@ -192,20 +629,32 @@ class UniformSampler:
 		return how many derivations there are from this nonterminal  
 		that generate a given length.
 		"""
-		return self.index[nonterminal][length]	
+		return self._value(self.index[nonterminal][length])
+
+	def get_log(self, nonterminal, length):
+		"""
+		return the natural log of how many derivations there are from
+		this nonterminal that generate a given length.
+		"""
+		return self._log(self.index[nonterminal][length])
 	
 
-	def multiple_sample(self, number, choose):
+	def multiple_sample(self, number, choose, limit=None):
 		"""
 		Return number samples of strings (perhaps multiple) as a list.
 		sampled without replacement.
 		Pick the lengths appropriately from a length that gives at least choose possibilities.
 
+		If limit is given the tables are grown as needed, up to that length.
 		"""
 		counts = []
 		lengths = []
 		total = 0
-		for i in xrange(self.max_length):
+		if limit is None:
+			limit = self.max_length
+		for i in xrange(limit):
+			if i > self.max_length:
+				self.extend_to(min(limit, 2 * self.max_length))
 			c = self.get_total(i)
 			total += c
 			lengths.append(i)
@@ -218,10 +667,18 @@ class UniformSampler:
 		else:
 			logging.warning("Sparse contexts")
 		result = []
-		distribution = [x / total for x in counts]
+		distribution = normalise(counts)
 		clengths = np.random.choice(lengths, number, p=distribution )
-		for l in clengths:
-			result.append(tuple(self.sample(l).collectYield()))
+		for l, n in collections.Counter(clengths).iteritems():
+			if self.mode == "exact" and self.get_total(l) <= n * n:
+				# repeats are likely, so draw distinct derivations,
+				# and repeats only once they have all been used
+				distinct = list(self.sample_without_replacement(None, [l] * n))
+				result.extend(distinct)
+				if len(distinct) < n:
+					result.extend(self.sample_batch(l, n - len(distinct)))
+			else:
+				result.extend(self.sample_batch(l, n))
 		return result
 			
 
@@ -230,16 +687,172 @@ class UniformSampler:
 		Sample a tree that generates a string of this length,
 		uniformly from all trees that generate a string of this length.
 		"""
-		# pick a start symbol.
-		total = self.start_totals[length]
-		if total == 0.0:
-			raise ValueError("Sampling from empty")
-		r = random.randrange(total)
-		for s in self.grammar.start_set:
-			r -= self.index[s][length]
-			if r < 0:
-				return self.sample_from_nonterminal(s,length)
-		raise ValueError("normalisation error")
+		return self.sample_from_nonterminal(self._pick_start(length),length)
+
+	def sample_yield(self, length):
+		"""
+		Sample a string of this length as a tuple, with the same
+		distribution as the yield of sample(length).
+		"""
+		return self.sample_yield_from(self._pick_start(length), length)
+
+	def sample_yield_from(self, nonterminal, length):
+		"""
+		Sample the yield of a tree of this length with this root, without
+		building the tree. Same distribution as 
+		sample_from_nonterminal(nonterminal, length).collectYield()
+		but returns a tuple.
+		"""
+		terminals = self.grammar.terminals
+		cache = self.cumulative
+		exact = self.mode == "exact"
+		# this is the inner loop of most experiments, so the draws
+		# of _choose are inlined.
+		uniform = random.random
+		randrange = random.randrange
+		bisect_right = bisect.bisect_right
+		result = []
+		# the symbols still to expand, leftmost at the end.
+		stack = [ (nonterminal, length) ]
+		while stack:
+			key = stack.pop()
+			symbol, l = key
+			if symbol in terminals:
+				if l != 1:
+					raise ValueError("terminals are of length 1")
+				result.append(symbol)
+				continue
+			items, cumulative = cache.get(key) or self._production_table(symbol, l)
+			if len(items) == 1:
+				prod = items[0]
+			elif exact:
+				prod = items[bisect_right(cumulative, randrange(cumulative[-1]))]
+			else:
+				prod = items[bisect_right(cumulative, uniform() * cumulative[-1])]
+			rhs = prod[1]
+			if len(rhs) == 1:
+				stack.append((rhs[0], l))
+			elif len(rhs) == 2:
+				items, cumulative = cache.get((prod, l)) or self._split_table(prod, l)
+				if len(items) == 1:
+					i = items[0]
+				elif exact:
+					i = items[bisect_right(cumulative, randrange(cumulative[-1]))]
+				else:
+					i = items[bisect_right(cumulative, uniform() * cumulative[-1])]
+				stack.append((rhs[1], l - i))
+				stack.append((rhs[0], i))
+		return tuple(result)
+
+	def sample_batch(self, length, n):
+		"""
+		Sample n strings of this length at once, each with the same
+		distribution as sample_yield(length). Returns a list of tuples.
+		"""
+		table = self._table(self.cumulative, (None, length),
+			lambda: [ (s, self.index[s][length]) for s in self.grammar.start_set ])
+		items = table[0]
+		return self._sample_yields([ (items[i], length) for i in self._draw_many(table, n) ])
+
+	def sample_batch_from(self, nonterminal, length, n):
+		"""
+		n samples of sample_yield_from(nonterminal, length) drawn at once.
+		"""
+		return self._sample_yields([ (nonterminal, length) ] * n)
+
+	def _sample_yields(self, roots):
+		"""
+		Sample a yield for each (symbol, length) in roots.
+
+		The derivations are expanded together, longest nodes first.  The
+		pending nodes of each length are kept as arrays of (symbol row,
+		which sample, where its yield starts), so all the nodes with the
+		same symbol and length make their choices in one numpy draw.
+		"""
+		n = len(roots)
+		width = max([ l for x, l in roots ] + [0])
+		out = np.zeros((n, width), dtype=int)
+		cache = self.batch_cumulative
+		# pending[l] is a list of (rows, samples, starts) arrays
+		pending = [ [] for l in xrange(width + 1) ]
+		def push(rows, samples, starts, lengths):
+			terminal = self.is_terminal[rows]
+			out[samples[terminal], starts[terminal]] = rows[terminal]
+			for members, l in _groups(lengths):
+				# empty yields need no more choices
+				if l > 0:
+					members = members[np.logical_not(terminal[members])]
+					pending[l].append((rows[members], samples[members], starts[members]))
+		push(np.array([ self.rows[x] for x, l in roots ], dtype=int), np.arange(n),
+			np.zeros(n, dtype=int), np.array([ l for x, l in roots ], dtype=int))
+		for l in xrange(width, 0, -1):
+			# unary rules and nullable daughters can add more of this length
+			while pending[l]:
+				rows = np.concatenate([ c[0] for c in pending[l] ])
+				samples = np.concatenate([ c[1] for c in pending[l] ])
+				starts = np.concatenate([ c[2] for c in pending[l] ])
+				pending[l] = []
+				# the daughters: rows, samples, starts, lengths
+				daughters = ([], [], [], [])
+				def add(rows, samples, starts, lengths):
+					for part, values in zip(daughters, (rows, samples, starts, lengths)):
+						part.append(values)
+				for members, row in _groups(rows):
+					nt = self.keys[row]
+					entry = cache.get((nt, l))
+					if entry is None:
+						table = self._production_table(nt, l)
+						entry = (table, np.array([ self.rows[x] for x in table[0] ], dtype=int),
+							self._cumulative_array(table[1]))
+						cache[(nt, l)] = entry
+					prods = entry[1][self._draw_many(entry[0], len(members), entry[2])]
+					for chosen, prod in _groups(prods):
+						chosen = members[chosen]
+						arity = self.arity[prod]
+						if arity == 1:
+							add(np.repeat(self.first[prod], len(chosen)), samples[chosen],
+								starts[chosen], np.repeat(l, len(chosen)))
+						elif arity == 2:
+							production = self.keys[prod]
+							entry = cache.get((production, l))
+							if entry is None:
+								table = self._split_table(production, l)
+								entry = (table, np.array(table[0], dtype=int),
+									self._cumulative_array(table[1]))
+								cache[(production, l)] = entry
+							split = entry[1][self._draw_many(entry[0], len(chosen), entry[2])]
+							add(np.repeat(self.first[prod], len(chosen)), samples[chosen],
+								starts[chosen], split)
+							add(np.repeat(self.second[prod], len(chosen)), samples[chosen],
+								starts[chosen] + split, l - split)
+				if daughters[0]:
+					push(*[ np.concatenate(part) for part in daughters ])
+		keys = self.keys
+		return [ tuple(keys[x] for x in out[j, :roots[j][1]]) for j in xrange(n) ]
+
+	def _pick_start(self, length):
+		return self._choose(self.cumulative, (None, length),
+			lambda: [ (s, self.index[s][length]) for s in self.grammar.start_set ])
+
+	def _production_table(self, nonterminal, length):
+		return self._table(self.cumulative, (nonterminal, length),
+			lambda: [ (prod, self.index[prod][length]) for prod in self.prodindex[nonterminal] ],
+			"Sampling from empty " + str(nonterminal) + " " + str(length))
+
+	def _split_table(self, production, length):
+		"""
+		Table for the length of the first daughter of a binary production.
+		"""
+		one, two = production[1]
+		return self._table(self.cumulative, (production, length),
+			lambda: [ (i, self._mul(self.index[one][i], self.index[two][length -i]))
+				for i in xrange(length + 1) ])
+
+	def _pick_production(self, nonterminal, length):
+		return self._draw(self._production_table(nonterminal, length))
+
+	def _pick_split(self, production, length):
+		return self._draw(self._split_table(production, length))
 
 	def sample_from_nonterminal(self, nonterminal, length):
 		"""
@@ -252,16 +865,8 @@ class UniformSampler:
 				return tree.TreeNode(nonterminal)
 			else:
 				raise ValueError("terminals are of length 1")
-		total = self.index[nonterminal][length]
-		if total == 0.0:
-			raise ValueError("Sampling from empty " + nonterminal + " " + str(length))
-		r = random.randrange(total)
-		for prod in self.prodindex[nonterminal]:
-			r -= self.index[prod][length]
-			if r < 0.0:
-				return self.sample_from_production(prod,length)
-		#print "Residue %f" % r
-		raise ValueError("normalisation error?" + str(r))
+		prod = self._pick_production(nonterminal, length)
+		return self.sample_from_production(prod,length)
 
 
 	def flatten(self, tree):
@@ -293,61 +898,269 @@ class UniformSampler:
 		one = rhs[0]
 		two = rhs[1]
 
-		total = self.index[production][length]
-		if total == 0.0:
-			raise ValueError("Sampling from empty")
-		r = random.randrange(total)
-		for i in xrange(length + 1):
-			value = self.index[one][i] * self.index[two][length -i] 
-			#print "split ", i, (length - i), "value", value
-			r -= value
-			if r < 0:
-				result.daughters.append(self.sample_from_nonterminal(one,i))
-				result.daughters.append(self.sample_from_nonterminal(two,length-i))
-				return self.flatten(result)
-		raise ValueError("normalisation error?")
+		i = self._pick_split(production, length)
+		result.daughters.append(self.sample_from_nonterminal(one,i))
+		result.daughters.append(self.sample_from_nonterminal(two,length-i))
+		return self.flatten(result)
+
 
 
+	def _start_table(self, length):
+		return self._table(self.cumulative, (None, length),
+			lambda: [ (s, self.index[s][length]) for s in self.grammar.start_set ])
 
-	def generateAll(self, length):
+	def _unrank_choice(self, table, i):
 		"""
-		generate all trees of a given width. Returns a list. Useful when there are only very few.
+		Return the item of the table that derivation i falls in and the
+		position of the derivation among those of the item.
+		This is the choice _draw makes when its random number is i.
 		"""
-		result = []
-		for s in self.grammar.start_set:
-			result.extend(generateAllFrom(s,length))
+		items, cumulative = table
+		j = bisect.bisect_right(cumulative, i)
+		if j == len(items) or i < 0:
+			raise ValueError("derivation index out of range")
+		if j == 0:
+			return items[0], i
+		return items[j], i - cumulative[j - 1]
+
+	def _check_exact(self):
+		if self.mode != "exact":
+			raise ValueError("ranking derivations needs exact counts")
+
+	def count(self, nonterminal, length):
+		"""
+		Number of derivations of this length from this nonterminal, or
+		from all the start symbols if nonterminal is None.
+		"""
+		if nonterminal is None:
+			return self.get_total(length)
+		return self.get(nonterminal, length)
+
+	def unrank(self, nonterminal, length, i):
+		"""
+		Return derivation number i, for 0 <= i < count(nonterminal, length),
+		as a tree.  Every number gives a different tree, and if i is
+		uniform the tree has the distribution of sample_from_nonterminal.
+		nonterminal None numbers the derivations from all the start symbols.
+		Only for exact counts.
+		"""
+		self._check_exact()
+		if nonterminal is None:
+			nonterminal, i = self._unrank_choice(self._start_table(length), i)
+		if nonterminal in self.grammar.terminals:
+			if length != 1 or i != 0:
+				raise ValueError("derivation index out of range")
+			return tree.TreeNode(nonterminal)
+		prod, i = self._unrank_choice(self._production_table(nonterminal, length), i)
+		result = tree.TreeNode(prod[0])
+		rhs = prod[1]
+		if len(rhs) == 1:
+			result.daughters.append(self.unrank(rhs[0], length, i))
+		elif len(rhs) == 2:
+			one, two = rhs
+			k, i = self._unrank_choice(self._split_table(prod, length), i)
+			i1, i2 = divmod(i, self.index[two][length - k])
+			result.daughters.append(self.unrank(one, k, i1))
+			result.daughters.append(self.unrank(two, length - k, i2))
+			self.flatten(result)
 		return result
 
-	def generateAllFrom(self, nonterminal, length):
+	def unrank_yield(self, nonterminal, length, i):
+		"""
+		The yield of unrank(nonterminal, length, i) as a tuple, without
+		building the tree.
+		"""
+		self._check_exact()
+		terminals = self.grammar.terminals
+		if nonterminal is None:
+			nonterminal, i = self._unrank_choice(self._start_table(length), i)
 		result = []
+		# the symbols still to expand, leftmost at the end.
+		stack = [ (nonterminal, length, i) ]
+		while stack:
+			symbol, l, i = stack.pop()
+			if symbol in terminals:
+				if l != 1 or i != 0:
+					raise ValueError("derivation index out of range")
+				result.append(symbol)
+				continue
+			prod, i = self._unrank_choice(self._production_table(symbol, l), i)
+			rhs = prod[1]
+			if len(rhs) == 1:
+				stack.append((rhs[0], l, i))
+			elif len(rhs) == 2:
+				one, two = rhs
+				k, i = self._unrank_choice(self._split_table(prod, l), i)
+				i1, i2 = divmod(i, self.index[two][l - k])
+				stack.append((two, l - k, i2))
+				stack.append((one, k, i1))
+		return tuple(result)
+
+	def rank(self, tree):
+		"""
+		Return the number of this tree among the derivations with the same
+		root and width, so that unrank(tree.label, width, rank(tree)) is
+		the same tree.  Only for exact counts.
+		"""
+		self._check_exact()
+		terminals = self.grammar.terminals
+		# widths of all the nodes, children before parents
+		widths = dict()
+		stack = [ (tree, False) ]
+		while stack:
+			node, done = stack.pop()
+			if done:
+				if node.daughters:
+					widths[id(node)] = sum(widths[id(d)] for d in node.daughters)
+				else:
+					widths[id(node)] = 1 if node.label in terminals else 0
+			else:
+				stack.append((node, True))
+				stack.extend((d, False) for d in node.daughters)
+		def rank_symbol(symbol, daughters, length):
+			# the position of the production and then of the daughters;
+			# for a binarised symbol daughters are the rest of its parent's.
+			if symbol in terminals:
+				return 0
+			if symbol in self.grammar.nonterminals:
+				prod = (symbol, tuple(d.label for d in daughters))
+				bprod = cfg.binarise_production(prod)[-1]
+			else:
+				bprod = self.prodindex[symbol][0]
+			items, cumulative = self._production_table(symbol, length)
+			j = items.index(bprod)
+			offset = cumulative[j - 1] if j > 0 else 0
+			rhs = bprod[1]
+			if len(rhs) == 0:
+				return offset
+			if len(rhs) == 1:
+				return offset + rank_symbol(rhs[0], daughters[0].daughters, length)
+			one, two = rhs
+			first = daughters[0]
+			k = widths[id(first)]
+			items, cumulative = self._split_table(bprod, length)
+			j = items.index(k)
+			offset += cumulative[j - 1] if j > 0 else 0
+			if len(daughters) == 2:
+				rest = daughters[1].daughters
+			else:
+				rest = daughters[1:]
+			r1 = rank_symbol(one, first.daughters, k)
+			r2 = rank_symbol(two, rest, length - k)
+			return offset + r1 * self.index[two][length - k] + r2
+		return rank_symbol(tree.label, tree.daughters, widths[id(tree)])
+
+	def sample_without_replacement(self, nonterminal, lengths):
+		"""
+		Generate yields of this nonterminal (all start symbols if None), one
+		for each length in lengths, never using the same derivation twice.
+		Lengths whose derivations have all been used are skipped.
+		Only for exact counts.
+		"""
+		self._check_exact()
+		used = collections.defaultdict(set)
+		for length in lengths:
+			count = self.count(nonterminal, length)
+			taken = used[length]
+			if len(taken) >= count:
+				continue
+			i = random.randrange(count)
+			while i in taken:
+				i = random.randrange(count)
+			taken.add(i)
+			yield self.unrank_yield(nonterminal, length, i)
+
+	def generateAll(self, length, limit=None):
+		"""
+		Generate all trees of a given width, at most limit of them.
+		Useful when there are only very few.
+		"""
+		trees = itertools.chain.from_iterable(self.generateAllFrom(s, length)
+			for s in self.grammar.start_set)
+		return itertools.islice(trees, limit)
+
+	def generateAllFrom(self, nonterminal, length):
+		"""
+		Generate all trees of this width with this root.
+		Only branches that have some derivations are explored.
+		"""
+		if nonterminal in self.grammar.terminals:
+			if length == 1:
+				yield tree.TreeNode(nonterminal)
+			return
 		for prod in self.prodindex[nonterminal]:
-			result.extend(generateAllFromProduction(prod,length))
-		return result
+			if self.index[prod][length] != self.zero:
+				for result in self.generateAllFromProduction(prod, length):
+					yield result
 
 	def generateAllFromProduction(self, production, length):
+		"""
+		Generate all trees of this width that start with this production.
+		"""
 		rhs = production[1]
 		lhs = production[0]
 		l = len(rhs)
-		result = []
 		if l == 0:
-			result.append(tree.TreeNode(lhs))
+			yield tree.TreeNode(lhs)
 		if l == 1:
-			subtrees = self.generateAllFrom(rhs[0],length)
-			for subtreet in subtrees:
+			for subtree in self.generateAllFrom(rhs[0],length):
 				root = tree.TreeNode(lhs)
-				result.daughters.append(subtree)
+				root.daughters.append(subtree)
+				yield root
 		if l == 2:
 			one = rhs[0]
 			two = rhs[1]
 			for i in xrange(length + 1):
-				value = self.index[one][i] * self.index[two][length -i] 
+				if self.index[one][i] == self.zero or self.index[two][length -i] == self.zero:
+					continue
 				for subtree1 in self.generateAllFrom(one,i):
 					for subtree2 in self.generateAllFrom(two,length-i):
 						root = tree.TreeNode(lhs)
 						root.daughters.append(subtree1)
 						root.daughters.append(subtree2)
-						results.append(self.flatten(root))
-		return result
+						yield self.flatten(root)
+
+	def enumerate_yields(self, length, limit=None):
+		"""
+		Generate the distinct strings of this length, as tuples,
+		stopping after limit of them.
+		"""
+		yields = itertools.chain.from_iterable(self._enumerate_yields(s, length)
+			for s in self.grammar.start_set)
+		return _distinct(yields, limit)
+
+	def enumerate_yields_from(self, nonterminal, length, limit=None):
+		"""
+		Generate the distinct yields of this length of this nonterminal,
+		stopping after limit of them.
+		"""
+		return _distinct(self._enumerate_yields(nonterminal, length), limit)
+
+	def _enumerate_yields(self, symbol, length):
+		"""
+		The yields of all derivations, with repeats, without building trees.
+		"""
+		if symbol in self.grammar.terminals:
+			if length == 1:
+				yield (symbol,)
+			return
+		for prod in self.prodindex[symbol]:
+			if self.index[prod][length] == self.zero:
+				continue
+			rhs = prod[1]
+			if len(rhs) == 0:
+				yield ()
+			elif len(rhs) == 1:
+				for w in self._enumerate_yields(rhs[0], length):
+					yield w
+			else:
+				one, two = rhs
+				for i in xrange(length + 1):
+					if self.index[one][i] == self.zero or self.index[two][length - i] == self.zero:
+						continue
+					for w1 in self._enumerate_yields(one, i):
+						for w2 in self._enumerate_yields(two, length - i):
+							yield w1 + w2
 
 
 
@@ -375,20 +1188,22 @@ class CrudeContextSampler:
 		self.middle = newterminal
 
 	def tree_to_context(self, tree):
-		w = tree.collectYield()
+		return self.yield_to_context(tree.collectYield())
+
+	def yield_to_context(self, w):
 		for i,v in enumerate(w):
 			if v == self.middle:
 				left = tuple(w[0:i])
 				right = tuple(w[i+1:])
 				return (left,right)
 		print w
-		raise ValueError("Programming error: no occurrence of marked symbol", middle)
+		raise ValueError("Programming error: no occurrence of marked symbol", self.middle)
 
 	def sample_context(self, length):
 		"""
 		return a context of this length.
 		"""
-		return self.tree_to_context(self.sampler.sample(length+1))
+		return self.yield_to_context(self.sampler.sample_yield(length+1))
 
 class ContextSampler:
 	"""
@@ -413,11 +1228,18 @@ class ContextSampler:
 	Then make an index of each of the bproductions.
 
 	"""
-	def __init__(self, grammar, uniformsampler, max_length):
+	def __init__(self, grammar, uniformsampler, max_length, cache_dir=None):
 		self.grammar = grammar
+		# the contexts of length l need yields of lengths up to l.
+		uniformsampler.extend_to(max_length)
 		self.us = uniformsampler
 		self.max_length = max_length
-		# index is a map from nonterminals to lists of floats
+		# counts are kept in the same mode as the uniform sampler.
+		self.mode = uniformsampler.mode
+		zero = uniformsampler.zero
+		# cumulative counts for sampling, keyed by (nonterminal or rprod, length)
+		self.cumulative = dict()
+		# index is a map from nonterminals and rprods to rows of the table
 		# index[nt][l] gives number of derivations
 
 		self.index = dict()
@@ -427,6 +1249,7 @@ class ContextSampler:
 		# remember to topologically sort the nonterminals
 		# so the 
 		self.eprodlist = []
+		keys = []
 		sortednts = grammar.topological_sort()
 		# prodmap an index from occurrences of nonter
 		prodmap = collections.defaultdict(list)
@@ -448,60 +1271,163 @@ class ContextSampler:
 					for i,rhsnt in enumerate(rhs):
 						rprod = (rhsnt, bprod,i)
 						rprodmap[rhsnt].append(rprod)
-						self.index[rprod] = [0.0] * (max_length+1)
+						keys.append(rprod)
 		rprodlist = []
 		for nt in sortedntsfull:
-			self.index[nt] = [0.0] * (max_length+1)
+			keys.append(nt)
 			rprodlist.extend(rprodmap[nt])
 		##now we have a good list of the rprods that we iterate through
 		self.rproductions = rprodlist
 		self.rprodmap = rprodmap
-		# initialise
-		for s in self.grammar.start_set:
-			self.index[s][0] = 1
+		# one row of the table per nonterminal and rprod
+		self.keys = []
+		self.rows = dict()
+		for key in keys:
+			if not key in self.rows:
+				self.rows[key] = len(self.keys)
+				self.keys.append(key)
+		table = None
+		if cache_dir is not None:
+			# a cached table has its rows in a canonical order.
+			self.keys.sort(key=repr)
+			for row, key in enumerate(self.keys):
+				self.rows[key] = row
+			path = _cache_path(cache_dir, "context", grammar, self.mode, max_length)
+			table = _load_table(path, self.mode, (len(self.keys), max_length + 1))
+		self._prepare_rprods()
+		if table is not None:
+			self.table = table
+			for key, row in self.rows.iteritems():
+				self.index[key] = self.table[row]
+		else:
+			self.table = uniformsampler._zeros((len(self.keys), max_length + 1))
+			for key, row in self.rows.iteritems():
+				self.index[key] = self.table[row]
+			# initialise
+			for s in self.grammar.start_set:
+				self.index[s][0] = uniformsampler.one
 			# recurse
-		for length in xrange(max_length+1):
+			for length in xrange(max_length+1):
+				self._process(length)
+			if cache_dir is not None:
+				_store_table(path, self.table)
+
+	def extend_to(self, max_length):
+		"""
+		Grow the tables to cover contexts up to max_length, computing only
+		the new lengths.  Grows the uniform sampler too if it is shorter.
+		"""
+		old = self.max_length
+		if max_length <= old:
+			return
+		self.us.extend_to(max_length)
+		table = self.us._zeros((len(self.keys), max_length + 1))
+		table[:, :old + 1] = self.table
+		self.table = table
+		for key, row in self.rows.iteritems():
+			self.index[key] = table[row]
+		self.max_length = max_length
+		for length in xrange(old + 1, max_length + 1):
 			self._process(length)
 
-	def _process(self, l):
-		# do the things for length l
+	def _prepare_rprods(self):
+		"""
+		Split the rprods like the productions of the uniform sampler: the
+		parts of a context whose root context is shorter are computed for
+		all rprods at once, and the rest, where the root context has the same
+		length, are added one at a time with every parent finished first.
+		"""
+		rows = self.rows
+		inside = self.us.rows
+		terminals = self.grammar.terminals
+		binary = []
+		lexical = []
+		rules = []
+		graph = collections.defaultdict(list)
 		for rprod in self.rproductions:
-			rhsnt,prod, i = rprod
-			lhs,rhs = prod
-			assert len(rhs) == 1 or len(rhs) == 2
-			increment = 0
+			rhsnt, prod, i = rprod
+			lhs, rhs = prod
+			rule = (rows[rprod], rows[rhsnt], rows[lhs])
 			if len(rhs) == 1:
-				increment = self.index[lhs][l]
-			if len(rhs) == 2:
+				rules.append(rule + (None,))
+			elif rhs[1-i] in terminals:
+				lexical.append(rule)
+				continue
+			else:
 				othernt = rhs[1-i]
-				#  check if other nt is a terminal for efficiency
-				if othernt in self.grammar.terminals:
-					# if it is then it only has one derivation and that is of length 1
-					increment = self.index[lhs][l-1]
-				else:
-					for root in xrange(l+1):
-						other = l - root
-						# the number of contexts of the parent * the number of derivations from the ither nonterminal
-						# of length other
-						increment += self.index[lhs][root] * self.us.index[othernt][other]
-			self.index[rprod][l] += increment
-			self.index[rhsnt][l] += increment
+				binary.append(rule + (inside[othernt],))
+				if self.us.index[othernt][0] == self.us.zero:
+					continue
+				rules.append(rule + (inside[othernt],))
+			graph[rhsnt].append(lhs)
+		self.binary_rows = np.array([ x[0] for x in binary ], dtype=int)
+		self.binary_target = np.array([ x[1] for x in binary ], dtype=int)
+		self.binary_lhs = np.array([ x[2] for x in binary ], dtype=int)
+		self.binary_other = np.array([ x[3] for x in binary ], dtype=int)
+		self.lexical_rows = np.array([ x[0] for x in lexical ], dtype=int)
+		self.lexical_target = np.array([ x[1] for x in lexical ], dtype=int)
+		self.lexical_lhs = np.array([ x[2] for x in lexical ], dtype=int)
+		position = dict()
+		for i, scc in enumerate(tarjan.strongly_connected_components(dict(graph))):
+			for x in scc:
+				position[x] = i
+		rules.sort(key = lambda rule: position[self.keys[rule[1]]])
+		self.same_length = rules
+
+	def _process(self, l):
+		"""
+		Compute the contexts of length l.
+		"""
+		table = self.table
+		inside = self.us.table
+		add = self.us._add
+		mul = self.us._mul
+		if l > 0:
+			column = table[:, l]
+			# root contexts of length 0 .. l-1 against sisters of length l .. 1
+			left = table[self.binary_lhs, :l]
+			right = inside[self.binary_other, l:0:-1]
+			lexical = table[self.lexical_lhs, l-1]
+			if self.mode == "float":
+				strict = np.einsum('ij,ij->i', left, right)
+				column += np.bincount(self.binary_target, weights=strict, minlength=len(self.keys))
+				column += np.bincount(self.lexical_target, weights=lexical, minlength=len(self.keys))
+			elif self.mode == "exact":
+				strict = (left * right).sum(axis=1)
+				np.add.at(column, self.binary_target, strict)
+				np.add.at(column, self.lexical_target, lexical)
+			else:
+				strict = np.logaddexp.reduce(left + right, axis=1)
+				np.logaddexp.at(column, self.binary_target, strict)
+				np.logaddexp.at(column, self.lexical_target, lexical)
+			table[self.binary_rows, l] = strict
+			table[self.lexical_rows, l] = lexical
+		for row, target, lhs, other in self.same_length:
+			if other is None:
+				increment = table[lhs, l]
+			else:
+				increment = mul(table[lhs, l], inside[other, 0])
+			table[row, l] = add(table[row, l], increment)
+			table[target, l] = add(table[target, l], increment)
 	
 			
+	def _context_table(self, nonterminal, length):
+		def choices():
+			result = [ (rprod, self.index[rprod][length]) for rprod in self.rprodmap[nonterminal] ]
+			if length == 0 and nonterminal in self.grammar.start_set:
+				# the empty context of a start symbol
+				result.append((None, self.us.one))
+			return result
+		return self.us._table(self.cumulative, (nonterminal, length), choices,
+			"sampling context where there are none.")
+
 	def sample_context(self, nonterminal, length):
-		total = self.index[nonterminal][length]
-		if total == 0:
-			raise ValueError("sampling context where there are none.")
-		alpha = random.randrange(total)
-		for rprod in self.rprodmap[nonterminal]:
-			alpha -= self.index[rprod][length]
-			if alpha < 0:
-				context = self.sample_context_rprod(rprod,length)
-				assert len(context[0]) + len(context[1]) == length
-				return context
-		if length == 0 and nonterminal in self.grammar.start_set:
+		rprod = self.us._draw(self._context_table(nonterminal, length))
+		if rprod is None:
 			return ((),())
-		raise ValueError("Normalisation error " + str(alpha))
+		context = self.sample_context_rprod(rprod,length)
+		assert len(context[0]) + len(context[1]) == length
+		return context
 
 
 	def _set_shortest_contexts(self):
@@ -538,7 +1464,7 @@ class ContextSampler:
 		for nonterminals and rprods.
 		"""
 		for i in xrange(self.max_length):
-			if self.index[nonterminal][i] > 0:
+			if self.index[nonterminal][i] != self.us.zero:
 				return i
 		return -1
 
@@ -565,7 +1491,7 @@ class ContextSampler:
 			else:
 				# we need to sample a length
 				l = self._pick_length(rprod, length)
-				subtree = tuple(self.us.sample_from_nonterminal(othernt,length-l).collectYield())
+				subtree = self.us.sample_yield_from(othernt,length-l)
 				assert len(subtree) == length -l
 				context = self.sample_context(lhs,l)
 				assert len(context[0]) + len(context[1]) == l
@@ -574,12 +1500,47 @@ class ContextSampler:
 			else:
 				return (context[0] + subtree, context[1])
 
+	def enumerate_contexts(self, nonterminal, length, limit=None):
+		"""
+		Generate the distinct contexts of this length of this nonterminal,
+		as (left, right) pairs, stopping after limit of them.
+		"""
+		return _distinct(self._enumerate_contexts(nonterminal, length), limit)
+
+	def _enumerate_contexts(self, nonterminal, length):
+		"""
+		The contexts of all context derivations, with repeats.
+		Only branches that have some derivations are explored.
+		"""
+		zero = self.us.zero
+		if length == 0 and nonterminal in self.grammar.start_set:
+			yield ((), ())
+		for rprod in self.rprodmap[nonterminal]:
+			if self.index[rprod][length] == zero:
+				continue
+			rhsnt, prod, i = rprod
+			lhs, rhs = prod
+			if len(rhs) == 1:
+				for context in self._enumerate_contexts(lhs, length):
+					yield context
+				continue
+			othernt = rhs[1-i]
+			for root in xrange(length + 1):
+				if self.index[lhs][root] == zero or self.us.index[othernt][length - root] == zero:
+					continue
+				for left, right in self._enumerate_contexts(lhs, root):
+					for w in self.us._enumerate_yields(othernt, length - root):
+						if i == 0:
+							yield (left, w + right)
+						else:
+							yield (left + w, right)
+
 	def get(self, nonterminal, length):
 		"""
 		return how many context derivations there are from this nonterminal  
 		that generate a given length.
 		"""
-		return self.index[nonterminal][length]	
+		return self.us._value(self.index[nonterminal][length])
 	
 
 	def _pick_length(self, rprod, length):
@@ -587,17 +1548,74 @@ class ContextSampler:
 		Pick how to split the context of this.
 		return the length of the root context
 		"""
+		return self.us._draw(self._length_table(rprod, length))
+
+	def _length_table(self, rprod, length):
 		rhsnt,prod, i = rprod
 		lhs,rhs = prod
-		total = self.index[rprod][length]
-		if total == 0:
-			raise ValueError("sampling context where there are none.")
-		alpha = random.randrange(total)
-		for root in xrange(length+1):
-			otherl = length - root
-			othernt = rhs[1-i]
-			increment = self.index[lhs][root] * self.us.index[othernt][otherl]
-			alpha -= increment
-			if alpha < 0:
-				return root
-		raise ValueError("Normalisation error in pick-length")
\ No newline at end of file
+		othernt = rhs[1-i]
+		return self.us._table(self.cumulative, (rprod, length),
+			lambda: [ (root, self.us._mul(self.index[lhs][root], self.us.index[othernt][length - root]))
+				for root in xrange(length+1) ],
+			"sampling context where there are none.")
+
+	def sample_context_batch(self, nonterminal, length, n):
+		"""
+		Sample n contexts of this nonterminal of this length at once, each
+		with the same distribution as sample_context(nonterminal, length).
+		Returns a list of (left, right) pairs.
+
+		Every sample climbs from the nonterminal to a start symbol; the
+		samples that are at the same symbol and length make their choices
+		in one numpy draw, and the yields of the sister nonterminals are
+		sampled together at the end.
+		"""
+		terminals = self.grammar.terminals
+		# the pieces added on each side, innermost first; a piece is a tuple
+		# or the index of a yield in requests.
+		lefts = [ [] for j in xrange(n) ]
+		rights = [ [] for j in xrange(n) ]
+		requests = []
+		frontier = { (nonterminal, length) : range(n) }
+		while frontier:
+			next_frontier = collections.defaultdict(list)
+			for (nt, l), members in frontier.iteritems():
+				table = self._context_table(nt, l)
+				picks = self.us._draw_many(table, len(members))
+				byrprod = collections.defaultdict(list)
+				for j, pick in zip(members, picks):
+					byrprod[table[0][pick]].append(j)
+				for rprod, group in byrprod.iteritems():
+					if rprod is None:
+						# reached the empty context of a start symbol
+						continue
+					rhsnt, prod, i = rprod
+					lhs, rhs = prod
+					if len(rhs) == 1:
+						next_frontier[(lhs, l)].extend(group)
+						continue
+					othernt = rhs[1-i]
+					side = rights if i == 0 else lefts
+					if othernt in terminals:
+						for j in group:
+							side[j].append((othernt,))
+						next_frontier[(lhs, l - 1)].extend(group)
+						continue
+					lengths = self._length_table(rprod, l)
+					roots = self.us._draw_many(lengths, len(group))
+					for j, pick in zip(group, roots):
+						root = lengths[0][pick]
+						side[j].append(len(requests))
+						requests.append((othernt, l - root))
+						next_frontier[(lhs, root)].append(j)
+			frontier = next_frontier
+		yields = self.us._sample_yields(requests)
+		def join(pieces):
+			result = ()
+			for piece in pieces:
+				if isinstance(piece, tuple):
+					result += piece
+				else:
+					result += yields[piece]
+			return result
+		return [ (join(reversed(lefts[j])), join(rights[j])) for j in xrange(n) ]
\ No newline at end of file